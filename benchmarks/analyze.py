@@ -0,0 +1,76 @@
+#!env python
+import os
+import sys
+import time
+import random
+import argparse
+import logging
+from pathlib import Path
+import numpy
+
+sys.path.insert(0, str(Path(os.path.realpath(__file__)).parent.parent))
+import busybody  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+
+def synthetic_rows(users, events_per_user, seed=0):
+    rng = random.Random(seed)
+    asns = ["Example ISP %s" % i for i in range(50)]
+    uas = ["Mozilla Browser %s" % i for i in range(50)]
+    rows = []
+    for user_no in range(users):
+        user = "user%s@example.com" % user_no
+        home = rng.uniform(-1, 1), rng.uniform(-1, 1), rng.uniform(-1, 1)
+        for _ in range(events_per_user):
+            rows.append([rng.uniform(0, 1e8), {}, user,
+                         home[0] + rng.gauss(0, 0.01), home[1] + rng.gauss(0, 0.01),
+                         home[2] + rng.gauss(0, 0.01), rng.choice(asns), rng.choice(uas), "synthetic"])
+    return sorted(rows, key=lambda row: row[0])
+
+
+def legacy_grouping(rows):
+    # The old analyze() loop: one full rescan of the history per user.
+    unique_users = list(set([e[2] for e in rows]))
+    for user in unique_users:
+        numpy.array([e for e in rows if e[2] == user], dtype=object)
+
+
+def run(users, events_per_user, legacy):
+    rows = synthetic_rows(users, events_per_user)
+    start = time.perf_counter()
+    store = busybody.group_events(rows)
+    grouped = time.perf_counter()
+    for user, user_events in store["users"].items():
+        busybody.analyze_user({}, user, user_events, store["asns"], store["uas"], 0)
+    analyzed = time.perf_counter()
+    result = {
+        "events": len(rows),
+        "group": grouped - start,
+        "analyze": analyzed - grouped,
+        "legacy_group": None
+    }
+    if legacy:
+        start = time.perf_counter()
+        legacy_grouping(rows)
+        result["legacy_group"] = time.perf_counter() - start
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure analysis time against event count.")
+    parser.add_argument("-u", "--users", default="50,100,200,400",
+                        help="Comma-separated list of user counts to run.")
+    parser.add_argument("-e", "--events-per-user", type=int, default=200,
+                        help="Events generated for every user.")
+    parser.add_argument("-l", "--legacy", action="store_true",
+                        help="Also time the old per-user rescan grouping.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARN)
+    print("%10s %10s %12s %12s %14s" % ("events", "group (s)", "analyze (s)", "us/event", "legacy (s)"))
+    for users in [int(u) for u in args.users.split(",")]:
+        result = run(users, args.events_per_user, args.legacy)
+        total = result["group"] + result["analyze"]
+        legacy = "%.3f" % result["legacy_group"] if result["legacy_group"] is not None else "-"
+        print("%10s %10.3f %12.3f %12.2f %14s" % (result["events"], result["group"], result["analyze"],
+                                                  total / result["events"] * 1e6, legacy))
@@ -0,0 +1,147 @@
+#!env python
+import json
+import random
+import argparse
+import ipaddress
+from datetime import datetime, timezone
+
+from fixtures import HOME_NETWORKS, REMOTE_NETWORKS
+
+# Synthetic login events shaped like what the slack and gsuite pollers hand to
+# busybody. Every user logs in from a few addresses in one or two home
+# networks with a few clients. Injected anomalies come from a remote network
+# with a client the user has never used, and are marked with ANOMALY_FIELD.
+
+ANOMALY_FIELD = "benchmark_anomaly"
+END_TIME = 1600000000
+CLIENT_WORDS = ["Mozilla", "Chrome", "Firefox", "Safari", "Edge", "Slack", "Electron",
+                "iOS", "Android", "Macintosh", "Windows", "Linux", "iPad", "ChromeOS"]
+LOGIN_TYPES = ["google_password", "saml", "reauth", "exchange", "unknown", "passkey"]
+ANOMALOUS_CLIENT = "curl libcurl"
+ANOMALOUS_LOGIN_TYPE = "legacy_app_password"
+
+
+def client_pool(size):
+    pool = []
+    for first in CLIENT_WORDS:
+        for second in CLIENT_WORDS:
+            if first != second:
+                pool.append("%s (%s) client" % (first, second))
+    return pool[:max(1, size)]
+
+
+def random_address(rng, network):
+    network = ipaddress.ip_network(network)
+    return str(network.network_address + rng.randrange(1, network.num_addresses - 1))
+
+
+def home_addresses(rng, ips_per_user):
+    networks = rng.sample(HOME_NETWORKS, 2)
+    return [random_address(rng, networks[0][0] if i % 3 else networks[1][0])
+            for i in range(max(1, ips_per_user))]
+
+
+def login_times(rng, events_per_user, days):
+    start = END_TIME - days * 86400
+    return sorted(rng.uniform(start, END_TIME) for _ in range(events_per_user))
+
+
+def generate(kind, users, events_per_user, ips_per_user=4, uas_per_user=3, ua_cardinality=20,
+             anomaly_rate=0.2, days=30, split=0.8, seed=0):
+    # Anomalies only land after the split, i.e. in the part of the history that
+    # is scored against a model trained on the part before it. They are kept a
+    # day clear of it, since G Suite times are read back as local time.
+    rng = random.Random(seed)
+    if kind == "slack":
+        pool = client_pool(ua_cardinality)
+    else:
+        pool = LOGIN_TYPES[:max(1, min(ua_cardinality, len(LOGIN_TYPES)))]
+    split_time = END_TIME - days * 86400 * (1 - split)
+    events = []
+    for user_no in range(users):
+        addresses = home_addresses(rng, ips_per_user)
+        clients = rng.sample(pool, min(len(pool), max(1, uas_per_user)))
+        for ts in login_times(rng, events_per_user, days):
+            events.append(make_event(kind, rng, user_no, ts, rng.choice(addresses), rng.choice(clients)))
+        if rng.random() < anomaly_rate:
+            remote = rng.choice(REMOTE_NETWORKS)[0]
+            event = make_event(kind, rng, user_no, rng.uniform(split_time + 86400, END_TIME),
+                               random_address(rng, remote),
+                               ANOMALOUS_CLIENT if kind == "slack" else ANOMALOUS_LOGIN_TYPE)
+            event[ANOMALY_FIELD] = True
+            events.append(event)
+    if kind == "slack":
+        events.sort(key=lambda event: event["date_last"])
+    else:
+        events.sort(key=lambda event: event["id"]["time"])
+    return events, split_time
+
+
+def make_event(kind, rng, user_no, ts, address, client):
+    if kind == "slack":
+        return slack_login(user_no, ts, address, client)
+    return gsuite_activity(rng, user_no, ts, address, client)
+
+
+def slack_login(user_no, ts, address, client):
+    # As returned by the slack poller, i.e. after the email has been added.
+    return {
+        "user_id": "U%08d" % user_no,
+        "username": "user%s" % user_no,
+        "email": "user%s@example.com" % user_no,
+        "date_first": int(ts) - 30,
+        "date_last": int(ts),
+        "count": 1,
+        "ip": address,
+        "user_agent": client,
+        "isp": "Example ISP",
+        "country": "US",
+        "region": "IL"
+    }
+
+
+def gsuite_activity(rng, user_no, ts, address, login_type):
+    # A raw Reports API activity, run it through gsuite.flatten() before use.
+    return {
+        "kind": "admin#reports#activity",
+        "id": {
+            "time": datetime.fromtimestamp(int(ts), timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+            "uniqueQualifier": str(rng.getrandbits(62)),
+            "applicationName": "login",
+            "customerId": "C01abcdef"
+        },
+        "etag": "\"%016x\"" % rng.getrandbits(64),
+        "actor": {
+            "email": "user%s@example.com" % user_no,
+            "profileId": str(100000000000 + user_no)
+        },
+        "ipAddress": address,
+        "events": [{
+            "type": "login",
+            "name": "login_success",
+            "parameters": [
+                {"name": "login_type", "value": login_type},
+                {"name": "is_suspicious", "boolValue": False},
+                {"name": "login_challenge_method", "multiValue": ["password"]}
+            ]
+        }]
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Print synthetic login events as JSON lines.")
+    parser.add_argument("kind", choices=["slack", "gsuite"],
+                        help="Shape of the generated events.")
+    parser.add_argument("-u", "--users", type=int, default=10,
+                        help="Number of users.")
+    parser.add_argument("-e", "--events-per-user", type=int, default=20,
+                        help="Events generated for every user.")
+    parser.add_argument("-a", "--anomaly-rate", type=float, default=0.2,
+                        help="Fraction of users that get one injected anomaly.")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Random seed.")
+    args = parser.parse_args()
+    events, split_time = generate(args.kind, args.users, args.events_per_user,
+                                  anomaly_rate=args.anomaly_rate, seed=args.seed)
+    for event in events:
+        print(json.dumps(event))
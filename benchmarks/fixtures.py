@@ -0,0 +1,158 @@
+#!env python
+import os
+import struct
+import argparse
+import ipaddress
+from pathlib import Path
+
+# Tiny GeoIP databases for the benchmarks, so they run without MaxMind
+# downloads. The databases are written in the MaxMind DB format
+# (https://maxmind.github.io/MaxMind-DB/) with only the features the fixtures
+# need: IPv4 trees, 32 bit records and no pointers in the data section.
+
+FIXTURE_DIR = Path(os.path.realpath(__file__)).parent / "fixtures"
+BUILD_EPOCH = 1600000000
+METADATA_MARKER = b"\xab\xcd\xefMaxMind.com"
+
+# (network, city, subdivision, country, continent, latitude, longitude, asn, organization)
+# Users log in from the "home" networks, injected anomalies from the "remote" ones.
+HOME_NETWORKS = [
+    ("10.0.0.0/16", "Springfield", "IL", "US", "NA", 39.80, -89.64, 64500, "Prairie Cable"),
+    ("10.1.0.0/16", "Chicago", "IL", "US", "NA", 41.88, -87.63, 64501, "Lakeshore Fiber"),
+    ("10.2.0.0/16", "Madison", "WI", "US", "NA", 43.07, -89.40, 64502, "Badger Broadband"),
+    ("10.3.0.0/16", "Indianapolis", "IN", "US", "NA", 39.77, -86.16, 64503, "Crossroads Net"),
+    ("10.4.0.0/16", "St. Louis", "MO", "US", "NA", 38.63, -90.20, 64504, "Gateway Wireless"),
+    ("10.5.0.0/16", "Minneapolis", "MN", "US", "NA", 44.98, -93.27, 64505, "Northstar Online"),
+    ("10.6.0.0/16", "Detroit", "MI", "US", "NA", 42.33, -83.05, 64506, "Motor City Data"),
+    ("10.7.0.0/16", "Columbus", "OH", "US", "NA", 39.96, -83.00, 64507, "Buckeye Telecom"),
+    ("10.8.0.0/16", "Des Moines", "IA", "US", "NA", 41.59, -93.62, 64508, "Cornbelt Access"),
+    ("10.9.0.0/16", "Milwaukee", "WI", "US", "NA", 43.04, -87.91, 64509, "Harbor Link"),
+    ("10.10.0.0/16", "Louisville", "KY", "US", "NA", 38.25, -85.76, 64510, "Bluegrass Cable"),
+    ("10.11.0.0/16", "Kansas City", "MO", "US", "NA", 39.10, -94.58, 64511, "Plains Fiber"),
+]
+REMOTE_NETWORKS = [
+    ("172.16.0.0/16", "Jakarta", None, "ID", "AS", -6.21, 106.85, 64520, "Archipelago Hosting"),
+    ("172.17.0.0/16", "Lagos", None, "NG", "AF", 6.52, 3.38, 64521, "Coastal Transit"),
+    ("172.18.0.0/16", "Sao Paulo", "SP", "BR", "SA", -23.55, -46.63, 64522, "Paulista Datacenter"),
+    ("172.19.0.0/16", "Novosibirsk", None, "RU", "EU", 55.01, 82.93, 64523, "Taiga Colocation"),
+]
+
+
+def encode_control(type_no, size):
+    if size < 29:
+        size_bytes = b""
+    elif size < 285:
+        size_bytes, size = bytes([size - 29]), 29
+    elif size < 65821:
+        size_bytes, size = struct.pack(">H", size - 285), 30
+    else:
+        size_bytes, size = struct.pack(">I", size - 65821)[1:], 31
+    if type_no < 8:
+        return bytes([(type_no << 5) | size]) + size_bytes
+    # Extended types are stored as type 0 with the real type in the next byte.
+    return bytes([size, type_no - 7]) + size_bytes
+
+
+def encode_uint(type_no, value):
+    data = value.to_bytes((value.bit_length() + 7) // 8, "big")
+    return encode_control(type_no, len(data)) + data
+
+
+def encode(value):
+    if isinstance(value, bool):
+        return encode_control(14, int(value))
+    if isinstance(value, str):
+        data = value.encode("utf-8")
+        return encode_control(2, len(data)) + data
+    if isinstance(value, float):
+        return encode_control(3, 8) + struct.pack(">d", value)
+    if isinstance(value, int):
+        return encode_uint(6 if value < 2 ** 32 else 9, value)
+    if isinstance(value, dict):
+        return encode_control(7, len(value)) + b"".join(encode(key) + encode(item)
+                                                        for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return encode_control(11, len(value)) + b"".join(encode(item) for item in value)
+    raise TypeError("Cannot encode %r in a MaxMind DB." % (value,))
+
+
+def write_database(path, database_type, records, description):
+    data = b""
+    offsets = {}
+    # Each node holds its left (bit 0) and right (bit 1) record. A record is
+    # another node, a data offset, or None for "not found".
+    nodes = [[None, None]]
+    for network, record in records:
+        network = ipaddress.ip_network(network)
+        encoded = encode(record)
+        if encoded not in offsets:
+            offsets[encoded] = len(data)
+            data += encoded
+        node = 0
+        bits = int(network.network_address)
+        for depth in range(network.prefixlen):
+            bit = (bits >> (31 - depth)) & 1
+            if depth == network.prefixlen - 1:
+                nodes[node][bit] = ("data", offsets[encoded])
+            else:
+                if nodes[node][bit] is None:
+                    nodes.append([None, None])
+                    nodes[node][bit] = ("node", len(nodes) - 1)
+                node = nodes[node][bit][1]
+    node_count = len(nodes)
+
+    def record_value(record):
+        if record is None:
+            return node_count
+        if record[0] == "node":
+            return record[1]
+        return node_count + 16 + record[1]
+
+    tree = b"".join(struct.pack(">II", record_value(left), record_value(right)) for left, right in nodes)
+    metadata = encode({
+        "node_count": node_count,
+        "record_size": 32,
+        "ip_version": 4,
+        "database_type": database_type,
+        "languages": ["en"],
+        "binary_format_major_version": 2,
+        "binary_format_minor_version": 0,
+        "build_epoch": BUILD_EPOCH,
+        "description": {"en": description}
+    })
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open('wb') as f:
+        f.write(tree + b"\x00" * 16 + data + METADATA_MARKER + metadata)
+
+
+def city_record(city, subdivision, country, continent, latitude, longitude):
+    record = {
+        "city": {"names": {"en": city}},
+        "continent": {"code": continent},
+        "country": {"iso_code": country},
+        "location": {"latitude": latitude, "longitude": longitude}
+    }
+    if subdivision:
+        record["subdivisions"] = [{"iso_code": subdivision}]
+    return record
+
+
+def write_fixtures(directory=FIXTURE_DIR):
+    networks = HOME_NETWORKS + REMOTE_NETWORKS
+    write_database(directory / "city.mmdb", "GeoLite2-City",
+                   [(entry[0], city_record(*entry[1:7])) for entry in networks],
+                   "Busybody benchmark city fixture")
+    write_database(directory / "asn.mmdb", "GeoLite2-ASN",
+                   [(entry[0], {"autonomous_system_number": entry[7],
+                                "autonomous_system_organization": entry[8]}) for entry in networks],
+                   "Busybody benchmark ASN fixture")
+    return directory / "city.mmdb", directory / "asn.mmdb"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Write the fixture GeoIP databases used by the benchmarks.")
+    parser.add_argument("-d", "--directory", default=str(FIXTURE_DIR),
+                        help="Directory to write city.mmdb and asn.mmdb into.")
+    args = parser.parse_args()
+    for path in write_fixtures(Path(args.directory)):
+        print("Wrote %s (%s bytes)." % (path, path.stat().st_size))
@@ -0,0 +1,96 @@
+#!env python
+import os
+import sys
+import time
+import random
+import argparse
+from pathlib import Path
+from collections.abc import Iterable
+
+sys.path.insert(0, str(Path(os.path.realpath(__file__)).parent.parent))
+from gsuite import gsuite  # noqa: E402
+
+
+def legacy_flatten(event, prefix=''):
+    # The recursive flattener that gsuite shipped with, kept for comparison.
+    flattened = {}
+    for field_no, field in enumerate(event):
+        if 'keys' in dir(event):
+            if field == "parameters":
+                for param in event[field]:
+                    if isinstance(param["value"], Iterable) and not isinstance(param["value"], str):
+                        flattened.update(param["value"], prefix + param["name"] + ".")
+                    else:
+                        flattened[prefix + param["name"]] = param["value"]
+                continue
+            else:
+                nextLevel = event[field]
+                currEntry = prefix + str(field)
+        else:
+            nextLevel = event[field_no]
+            currEntry = prefix + str(field_no)
+        if isinstance(nextLevel, Iterable) and not isinstance(nextLevel, str):
+            flattened.update(legacy_flatten(nextLevel, currEntry + "."))
+        else:
+            flattened[currEntry] = nextLevel
+    return flattened
+
+
+def login_activity(rng, number):
+    # Shaped like an item of the Reports API activities().list(applicationName='login').
+    return {
+        "kind": "admin#reports#activity",
+        "etag": "\"%032x\"" % rng.getrandbits(128),
+        "id": {
+            "time": "2018-06-%02dT%02d:%02d:%02d.%03dZ" % (
+                rng.randint(1, 28), rng.randint(0, 23), rng.randint(0, 59), rng.randint(0, 59),
+                rng.randint(0, 999)),
+            "uniqueQualifier": str(rng.getrandbits(63)),
+            "applicationName": "login",
+            "customerId": "C0123abcd"
+        },
+        "actor": {
+            "email": "user%s@example.com" % (number % 500),
+            "profileId": str(100000000000000000000 + number % 500)
+        },
+        "ipAddress": "203.0.113.%s" % rng.randint(1, 254),
+        "events": [{
+            "type": "login",
+            "name": rng.choice(["login_success", "login_success", "login_failure", "logout"]),
+            "parameters": [
+                {"name": "login_type", "value": rng.choice(["google_password", "saml", "reauth"])},
+                {"name": "login_challenge_method", "value": "password"},
+                {"name": "is_suspicious", "value": "false"}
+            ]
+        }]
+    }
+
+
+def timed(func, events, rounds):
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for event in events:
+            func(event)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare G Suite flattener implementations.")
+    parser.add_argument("-n", "--events", type=int, default=20000, help="Number of activities to flatten.")
+    parser.add_argument("-r", "--rounds", type=int, default=3, help="Rounds to run, the best one is reported.")
+    args = parser.parse_args()
+    rng = random.Random(0)
+    events = [login_activity(rng, i) for i in range(args.events)]
+    assert all(legacy_flatten(event) == gsuite.flatten(event) for event in events[:100])
+    results = [
+        ("legacy recursive", timed(legacy_flatten, events, args.rounds)),
+        ("iterative, full", timed(gsuite.flatten, events, args.rounds)),
+        ("compiled fields", timed(lambda event: gsuite.flatten(event, False), events, args.rounds))
+    ]
+    baseline = results[0][1]
+    print("%-18s %10s %12s %8s" % ("flattener", "total (s)", "us/event", "speedup"))
+    for name, elapsed in results:
+        print("%-18s %10.3f %12.2f %7.1fx" % (name, elapsed, elapsed / args.events * 1e6, baseline / elapsed))
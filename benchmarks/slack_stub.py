@@ -0,0 +1,131 @@
+#!env python
+import json
+import time
+import random
+import argparse
+import threading
+from urllib.parse import parse_qs, urlparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from events import random_address
+from fixtures import HOME_NETWORKS
+
+# A stand-in for the Slack Web API, serving canned pages with artificial
+# latency. Point busybody at it by setting "api_url" in the slack pollers or
+# notifiers section to http://HOST:PORT/api. Logins come from the home
+# networks of the fixture GeoIP databases, so they can be analyzed too.
+
+
+def canned_logins(pages, page_size, users, seed=0):
+    rng = random.Random(seed)
+    now = int(time.time())
+    logins = []
+    for i in range(pages * page_size):
+        user = rng.randrange(users)
+        logins.append({
+            "user_id": "U%08d" % user,
+            "username": "user%s" % user,
+            "date_first": now - i * 60 - 30,
+            "date_last": now - i * 60,
+            "count": 1,
+            "ip": random_address(rng, rng.choice(HOME_NETWORKS)[0]),
+            "user_agent": rng.choice(["Mozilla/5.0 (Macintosh) Slack/3.1.0", "com.tinyspeck.chatlyio/2.60"]),
+            "isp": "Example ISP",
+            "country": "US",
+            "region": "CA"
+        })
+    return logins
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        length = int(self.headers["Content-Length"] or 0)
+        params = {key: values[0] for key, values in parse_qs(self.rfile.read(length).decode("utf-8")).items()}
+        self.handle_api(urlparse(self.path).path.rsplit("/", 1)[-1], params)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        self.handle_api(url.path.rsplit("/", 1)[-1], params)
+
+    def handle_api(self, method, params):
+        server = self.server
+        time.sleep(server.latency)
+        with server.lock:
+            server.calls[method] = server.calls.get(method, 0) + 1
+            calls = sum(server.calls.values())
+        if server.rate_limit and calls % server.rate_limit == 0:
+            self.send_response(429)
+            self.send_header("Retry-After", "1")
+            self.end_headers()
+            return
+        if method == "team.accessLogs":
+            page = int(params.get("page", 1))
+            size = server.page_size
+            result = {"ok": True, "logins": server.logins[(page - 1) * size:page * size],
+                      "paging": {"count": size, "total": len(server.logins), "page": page,
+                                 "pages": server.pages}}
+        elif method == "users.info":
+            result = {"ok": True, "user": self.user(int(params["user"][1:]))}
+        elif method == "users.list":
+            start = int(params.get("cursor") or 0)
+            limit = int(params.get("limit", 200))
+            members = [self.user(i) for i in range(start, min(start + limit, server.users))]
+            cursor = str(start + limit) if start + limit < server.users else ""
+            result = {"ok": True, "members": members, "response_metadata": {"next_cursor": cursor}}
+        elif method == "chat.postMessage":
+            with server.lock:
+                server.messages.append(params)
+            result = {"ok": True, "ts": "%.6f" % time.time()}
+        else:
+            result = {"ok": False, "error": "unknown_method"}
+        body = json.dumps(result).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def user(self, number):
+        return {"id": "U%08d" % number, "is_bot": False,
+                "profile": {"email": "user%s@example.com" % number}}
+
+    def log_message(self, format, *args):
+        return
+
+
+def serve(host="127.0.0.1", port=0, pages=10, page_size=100, users=50, latency=0.1, rate_limit=0):
+    server = ThreadingHTTPServer((host, port), StubHandler)
+    server.daemon_threads = True
+    server.pages = pages
+    server.page_size = page_size
+    server.users = users
+    server.latency = latency
+    server.rate_limit = rate_limit
+    server.logins = canned_logins(pages, page_size, users)
+    server.calls = {}
+    server.messages = []
+    server.lock = threading.Lock()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve canned Slack API pages with artificial latency.")
+    parser.add_argument("-p", "--port", type=int, default=8089, help="Port to listen on.")
+    parser.add_argument("--pages", type=int, default=10, help="Number of access log pages to serve.")
+    parser.add_argument("--page-size", type=int, default=100, help="Access log entries per page.")
+    parser.add_argument("--users", type=int, default=50, help="Number of distinct users.")
+    parser.add_argument("--latency", type=float, default=0.1, help="Seconds to wait before every response.")
+    parser.add_argument("--rate-limit", type=int, default=0,
+                        help="Answer every Nth request with HTTP 429. (Default: never)")
+    args = parser.parse_args()
+    server = serve(port=args.port, pages=args.pages, page_size=args.page_size, users=args.users,
+                   latency=args.latency, rate_limit=args.rate_limit)
+    print("Serving the Slack API stub on http://127.0.0.1:%s/api" % server.server_address[1])
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
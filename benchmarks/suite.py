@@ -0,0 +1,190 @@
+#!env python
+import os
+import sys
+import json
+import argparse
+import logging
+import tempfile
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, str(Path(os.path.realpath(__file__)).parent.parent))
+import busybody  # noqa: E402
+import events  # noqa: E402
+from fixtures import FIXTURE_DIR  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+STAGES = ["flatten", "flatfile.write", "load_historical", "preprocess", "build_store", "analyze"]
+
+
+def benchmark_config(log_dir, kinds, workers, engine):
+    config = {
+        "mode": "benchmark",
+        "workers": workers,
+        "shard": None,
+        "checkpoint": "last_analyzed",
+        "stream": False,
+        "persistence": {"module": "flatfile", "log_directory": log_dir},
+        "pollers": {kind: {} for kind in kinds},
+        "analysis": {
+            "geoip": {"city_db": str(FIXTURE_DIR / "city.mmdb"), "asn_db": str(FIXTURE_DIR / "asn.mmdb")}
+        },
+        "active_modules": {"pollers": list(kinds), "analysis": list(kinds), "persistence": "flatfile"}
+    }
+    for kind in kinds:
+        config["analysis"][kind] = {}
+        busybody.import_module(kind)
+    busybody.import_module("flatfile")
+    if engine != busybody.BATCH_ENGINE:
+        config["analysis"]["engine"] = {"module": engine}
+        config["active_modules"]["engine"] = engine
+        busybody.import_module(engine)
+    return config
+
+
+def generate(kinds, users, events_per_user, options):
+    data = {}
+    split_time = None
+    for kind_no, kind in enumerate(kinds):
+        generated, split_time = events.generate(kind, users, events_per_user,
+                                                ips_per_user=options.ips_per_user,
+                                                uas_per_user=options.uas_per_user,
+                                                ua_cardinality=options.ua_cardinality,
+                                                anomaly_rate=options.anomaly_rate,
+                                                seed=options.seed + kind_no)
+        data[kind] = generated
+    if "gsuite" in data:
+        with busybody.stage("flatten") as record:
+            flatten = getattr(sys.modules["gsuite"], "gsuite").flatten
+            data["gsuite"] = [flatten(event) for event in data["gsuite"]]
+            record["events"] = len(data["gsuite"])
+    return data, split_time
+
+
+def score(store, flagged_users, split_time):
+    import numpy
+    result = {"injected": 0, "detected": 0, "scored": 0, "false_positives": 0}
+    for user, user_events in store["users"].items():
+        start = int(numpy.searchsorted(user_events.times, split_time, side="left"))
+        anomalies = set(ev_no for ev_no in range(start, len(user_events.times))
+                        if events.ANOMALY_FIELD in user_events.events[ev_no])
+        flagged = set(int(ev_no) for ev_no in flagged_users.get(user, []))
+        result["injected"] += len(anomalies)
+        result["detected"] += len(anomalies & flagged)
+        result["scored"] += len(user_events.times) - start - len(anomalies)
+        result["false_positives"] += len(flagged - anomalies)
+    return result
+
+
+def run_scale(kinds, users, events_per_user, options):
+    logging.basicConfig(level=logging.WARN)
+    busybody.reset_metrics()
+    with tempfile.TemporaryDirectory() as log_dir:
+        config = benchmark_config(log_dir, kinds, options.workers, options.engine)
+        data, split_time = generate(kinds, users, events_per_user, options)
+        total = sum(len(module_events) for module_events in data.values())
+        flatfile = getattr(sys.modules["flatfile"], "flatfile")
+        with busybody.stage("flatfile.write") as record:
+            flatfile.persist(config, data)
+            record["events"] = total
+        del data
+        data = busybody.load_historical(config)
+        rows = busybody.preprocess(config, data)
+        del data
+        store = busybody.build_store(config, rows)
+        del rows
+        flagged_users = {}
+        with busybody.stage("analyze") as record:
+            for user, flagged in busybody.analyze_users(config, store, split_time):
+                if flagged is not None:
+                    flagged_users[user] = flagged
+                    record["users"] += 1
+        summary = busybody.metrics_summary(config)
+    result = {
+        "engine": options.engine,
+        "kinds": kinds,
+        "users": users,
+        "events_per_user": events_per_user,
+        "events": total,
+        "stages": summary["stages"],
+        "max_rss_bytes": max(summary["max_rss_bytes"], summary["workers_max_rss_bytes"]),
+        "user_analysis": {key: value for key, value in summary["user_analysis"].items() if key != "slowest"},
+        "geoip": summary["geoip"]
+    }
+    result.update(score(store, flagged_users, split_time))
+    result["recall"] = float(result["detected"]) / result["injected"] if result["injected"] else None
+    result["false_positive_rate"] = float(result["false_positives"]) / result["scored"] \
+        if result["scored"] else None
+    return result
+
+
+def report(result):
+    lines = ["%s users x %s events per user, %s (%s events, %s anomalies injected), %s engine" %
+             (result["users"], result["events_per_user"], "+".join(result["kinds"]), result["events"],
+              result["injected"], result["engine"]),
+             "  %-16s %10s %10s %12s %10s" % ("stage", "wall (s)", "cpu (s)", "events/s", "rss (MB)")]
+    for name in STAGES:
+        if name not in result["stages"]:
+            continue
+        stage = result["stages"][name]
+        handled = stage["events"] if "events" in stage else result["events"]
+        lines.append("  %-16s %10.3f %10.3f %12.0f %10.1f" %
+                     (name, stage["wall_seconds"], stage["cpu_seconds"],
+                      handled / stage["wall_seconds"] if stage["wall_seconds"] else 0,
+                      stage["max_rss_bytes"] / 1048576.0))
+    lines.append("  per user: %.3f s median, %.3f s p95" %
+                 (result["user_analysis"]["p50_seconds"], result["user_analysis"]["p95_seconds"]))
+    lines.append("  recall: %s (%s of %s), false positive rate: %s (%s of %s)" %
+                 ("%.3f" % result["recall"] if result["recall"] is not None else "-",
+                  result["detected"], result["injected"],
+                  "%.4f" % result["false_positive_rate"] if result["false_positive_rate"] is not None else "-",
+                  result["false_positives"], result["scored"]))
+    lines.append("  peak rss: %.1f MB" % (result["max_rss_bytes"] / 1048576.0))
+    return "\n".join(lines)
+
+
+def parse_scales(value):
+    try:
+        scales = [tuple(int(part) for part in scale.split("x")) for scale in value.split(",")]
+    except ValueError:
+        scales = []
+    if not scales or any(len(scale) != 2 for scale in scales):
+        raise argparse.ArgumentTypeError("Scales must be given as USERSxEVENTS, e.g. 100x50.")
+    return scales
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run synthetic events through busybody at several scales.")
+    parser.add_argument("-s", "--scales", type=parse_scales, default="20x50,100x50,200x100",
+                        help="Comma-separated list of USERSxEVENTS_PER_USER to run.")
+    parser.add_argument("-k", "--kinds", default="slack,gsuite",
+                        help="Comma-separated list of modules to generate events for.")
+    parser.add_argument("--ips-per-user", type=int, default=4,
+                        help="Addresses every user logs in from.")
+    parser.add_argument("--uas-per-user", type=int, default=3,
+                        help="Clients every user logs in with.")
+    parser.add_argument("--ua-cardinality", type=int, default=20,
+                        help="Size of the pool that the clients of all users are drawn from.")
+    parser.add_argument("-a", "--anomaly-rate", type=float, default=0.2,
+                        help="Fraction of users that get one injected anomaly per module.")
+    parser.add_argument("-e", "--engine", default=busybody.BATCH_ENGINE,
+                        help="Analysis engine to score the users with.")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="Number of processes used to analyze users.")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Random seed for the event generator.")
+    parser.add_argument("-j", "--json", default=None,
+                        help="Also write the results to this file as JSON.")
+    args = parser.parse_args()
+    kinds = args.kinds.split(",")
+    results = []
+    for users, events_per_user in args.scales:
+        # A fresh process for every scale, so that its peak memory is its own.
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            result = executor.submit(run_scale, kinds, users, events_per_user, args).result()
+        print(report(result))
+        results.append(result)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({"version": busybody.program_version, "results": results}, f, indent=2)
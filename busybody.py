@@ -6,21 +6,89 @@ import yaml
 import logging
 from pathlib import Path
 import importlib
+import builtins
+import heapq
+import itertools
+import time
+import signal
+import resource
+import threading
 import re
-import geoip2.database
-from datetime import datetime
-import numpy
-from scipy.sparse import hstack
-from sklearn.preprocessing import scale
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.ensemble import IsolationForest
+import zlib
+import fcntl
+import hashlib
+import json
+from datetime import datetime, timedelta
+from contextlib import contextmanager
+from collections import namedtuple, OrderedDict, Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 program_version = "1.0"
+# Bump whenever the layout of the cached per-user models changes.
+MODEL_VERSION = 1
+# Seconds between polls in daemon mode, unless a poller sets its own interval.
+DEFAULT_POLL_INTERVAL = 300
+# Seconds before a daemon retries a failed poller, doubled with every failure
+# in a row up to the maximum.
+RETRY_DELAY = 30
+MAX_RETRY_DELAY = 3600
+# Entries of the "analysis" config section that are settings, not modules.
+ANALYSIS_SETTINGS = ("geoip", "history_limit", "model_cache", "event_cache", "engine")
+# The engine that is used unless another one is configured.
+BATCH_ENGINE = "isolation_forest"
+# Bump whenever preprocessing changes what ends up in the event cache.
+CACHE_VERSION = 2
+# Fields that preprocessing adds to every event.
+PREPROCESS_FIELDS = ("ip_location", "asn")
+# Events are preprocessed in batches of this many, so streams stay streams.
+PREPROCESS_BATCH = 10000
+UA_FILTER = re.compile('[a-zA-Z:\._\(\)-]*([0-9]+[a-zA-Z:\._\(\)-]*)+')
+ISO_TIMESTAMP = re.compile('[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2}[.][0-9]{1,6}Z')
+CACHE_COLUMNS = {
+    "ts": ("f8", 1),
+    "xyz": ("f8", 3),
+    "module": ("i2", 1),
+    "user": ("i4", 1),
+    "asn": ("i4", 1),
+    "ua": ("i4", 1),
+    "offset": ("i8", 1)
+}
 
 logger = logging.getLogger(__name__)
 
+UserEvents = namedtuple("UserEvents", ["times", "xyz", "asns", "uas", "events"])
 
-def poll(config):
+worker_state = {}
+
+# Filled in by --profile-startup, import times only cover the outermost import.
+startup_profile = {
+    "enabled": False,
+    "core": 0,
+    "imports": {},
+    "stages": {}
+}
+import_depth = threading.local()
+
+# Timings of the current run (or daemon cycle). Counters kept by the modules
+# themselves, like GeoIP and API calls, are totals for the life of the process.
+run_metrics = {
+    "started": None,
+    "stages": OrderedDict(),
+    "users": []
+}
+metrics_lock = threading.Lock()
+
+geoip_state = {
+    "readers": None,
+    "builds": None,
+    "cache": OrderedDict(),
+    "size": 65536,
+    "hits": 0,
+    "misses": 0
+}
+
+
+def poll(config, pollers=None, errors=None):
     data = {}
     if "persistence" in config["active_modules"] and config["active_modules"]["persistence"]:
         persist_module = getattr(sys.modules[config["active_modules"]["persistence"]],
@@ -28,146 +96,886 @@ def poll(config):
         get_last_func = getattr(persist_module, "get_last")
         persist_func = getattr(persist_module, "persist")
         config = get_last_func(config)
-    for poller in config["active_modules"]["pollers"]:
-        poll_mod = getattr(sys.modules[poller], poller)
-        ts_field = poll_mod.TIMESTAMP_FIELD
-        poll_func = getattr(poll_mod, "poll")
-        logger.info("Polling %s for new events..." % poller)
-        data[poller] = poll_func(config)
-        data[poller].sort(key=lambda k: k[ts_field])
+    # Pollers spend most of their time waiting on the network, so they all run
+    # at once and their results are merged before anything is persisted.
+    if pollers is None:
+        pollers = config["active_modules"]["pollers"]
+
+    def run_poller(poller):
+        with stage("poll." + poller) as record:
+            events = getattr(getattr(sys.modules[poller], poller), "poll")(config)
+            record["events"] = len(events)
+        return events
+
+    with stage("poll") as record, ThreadPoolExecutor(max_workers=max(1, len(pollers))) as executor:
+        futures = {}
+        for poller in pollers:
+            logger.info("Polling %s for new events..." % poller)
+            futures[poller] = executor.submit(run_poller, poller)
+        failed = {}
+        for poller, future in futures.items():
+            ts_field = getattr(sys.modules[poller], poller).TIMESTAMP_FIELD
+            try:
+                data[poller] = future.result()
+            except Exception as e:
+                # The other pollers' events are still persisted.
+                logger.exception("Polling %s failed." % poller)
+                failed[poller] = e
+                continue
+            data[poller].sort(key=lambda k: k[ts_field])
+            record["events"] += len(data[poller])
+            logger.info("Polled %s new events from %s." % (len(data[poller]), poller))
     if "persistence" in config["active_modules"] and config["active_modules"]["persistence"]:
-        persist_func(config, data)
-    return
+        with stage("persist") as record:
+            persist_func(config, data)
+            record["events"] = sum(len(events) for events in data.values())
+    if errors is not None:
+        errors.update(failed)
+    elif failed:
+        raise next(iter(failed.values()))
+    return data
 
 
 def load_historical(config):
+    with stage("load_historical") as record:
+        data = load_stored(config)
+        # Streamed history is only read as it is preprocessed.
+        record["events"] = sum(len(events) for events in data.values() if isinstance(events, list))
+    return data
+
+
+def load_stored(config):
     if "persistence" in config["active_modules"] and config["active_modules"]["persistence"]:
         persist_module = getattr(sys.modules[config["active_modules"]["persistence"]],
                                  config["active_modules"]["persistence"])
         get_last_func = getattr(persist_module, "get_last")
         config = get_last_func(config)
-        get_historical_func = getattr(persist_module, "get_historical_data")
-        data = get_historical_func(config)
+        if event_cache_directory(config):
+            # Not in the middle of a compaction, which hides the metadata.
+            with cache_lock(event_cache_directory(config)):
+                meta = load_event_cache(config)["meta"]
+            config["cache_high_water"] = meta["high_water"]
+            config["cache_boundary"] = {module: Counter(digests) for module, digests in meta["boundary"].items()}
+        # The persistence module only hands over events from here on.
+        config["history_start"] = {module: read_start(config, module)
+                                   for module in config["active_modules"]["analysis"]}
+        if hasattr(persist_module, "iter_module_history"):
+            iter_module_func = getattr(persist_module, "iter_module_history")
+            data = {module: iter_module_func(config, module) for module in config["history_start"]}
+            if "stream" not in config or not config["stream"]:
+                data = {module: list(events) for module, events in data.items()}
+        else:
+            get_historical_func = getattr(persist_module, "get_historical_data")
+            data = get_historical_func(config)
     return data
 
 
 def preprocess(config, data):
     processed = []
-    ua_filter = re.compile('[a-zA-Z:\._\(\)-]*([0-9]+[a-zA-Z:\._\(\)-]*)+')
-    for module in data:
-        poll_mod = getattr(sys.modules[module], module)
-        ts_field = poll_mod.TIMESTAMP_FIELD
-        user_field = poll_mod.USER_FIELD
-        ip_field = poll_mod.IP_FIELD
-        ua_field = poll_mod.USER_AGENT_FIELD
-        filter_field = poll_mod.FILTER_FIELD
-        city_lookup = geoip2.database.Reader(config["analysis"]["geoip"]["city_db"])
-        asn_lookup = geoip2.database.Reader(config["analysis"]["geoip"]["asn_db"])
-        for event in data[module]:
-            if filter_field:
-                if event[filter_field] in poll_mod.FILTERED_EVENTS:
-                    continue
-            if ts_field not in event or not event[ts_field] or user_field not in event or \
-               not event[user_field] or ip_field not in event or not event[ip_field] or \
-               ua_field not in event or not event[ua_field]:
+    with stage("preprocess") as record:
+        for module in data:
+            processed.extend(preprocess_module(config, module, data[module]))
+        log_geoip_cache(config)
+        processed.sort(key=lambda event: event[0])
+        record["events"] = len(processed)
+    return processed
+
+
+def preprocess_stream(config, data):
+    # Every module yields its events in timestamp order, so a k-way merge
+    # replaces the global sort and no module's history is held in memory.
+    streams = [preprocess_module(config, module, data[module]) for module in data]
+    yield from heapq.merge(*streams, key=lambda event: event[0])
+    log_geoip_cache(config)
+
+
+def preprocess_module(config, module, events):
+    events = iter(events)
+    while True:
+        batch = list(itertools.islice(events, PREPROCESS_BATCH))
+        if not batch:
+            return
+        yield from preprocess_batch(config, module, batch)
+
+
+def preprocess_batch(config, module, events):
+    high_water = {}
+    if "cache_high_water" in config:
+        high_water = config["cache_high_water"]
+        boundary = config["cache_boundary"]
+    poll_mod = getattr(sys.modules[module], module)
+    ts_field = poll_mod.TIMESTAMP_FIELD
+    user_field = poll_mod.USER_FIELD
+    ip_field = poll_mod.IP_FIELD
+    ua_field = poll_mod.USER_AGENT_FIELD
+    filter_field = poll_mod.FILTER_FIELD
+    settings = config["analysis"][module]
+    kept = []
+    for event in events:
+        if filter_field:
+            if event[filter_field] in poll_mod.FILTERED_EVENTS:
                 continue
-            if type(event[ts_field]) == str and "T" in event[ts_field]:
-                ts = datetime.timestamp(datetime.strptime(event[ts_field], '%Y-%m-%dT%H:%M:%S.%fZ'))
-            else:
-                ts = event[ts_field]
-            if "user_map" in config["analysis"][module] and \
-               event[user_field] in config["analysis"][module]["user_map"]:
-                user = config["analysis"][module]["user_map"][event[user_field]]
-            else:
-                user = event[user_field]
-            if "user_domain" in config["analysis"][module] and '@' not in user:
-                user = "@".join((user, config["analysis"][module]["user_domain"]))
-            user_agent = ua_filter.sub('', event[ua_field])
-            if event[ip_field] is None:
+        if ts_field not in event or not event[ts_field] or user_field not in event or \
+           not event[user_field] or ip_field not in event or not event[ip_field] or \
+           ua_field not in event or not event[ua_field]:
+            continue
+        kept.append(event)
+    times = parse_timestamps([event[ts_field] for event in kept])
+    if module in high_water:
+        fresh = []
+        for event, ts in zip(kept, times):
+            if ts < high_water[module]:
                 continue
-            city = city_lookup.city(event[ip_field])
-            readable = []
-            if "en" in city.city.names and city.city.names["en"]:
-                readable.append(city.city.names["en"])
-            if city.subdivisions and city.subdivisions[0].iso_code:
-                readable.append(city.subdivisions[0].iso_code)
-            if city.country and city.country.iso_code:
-                readable.append(city.country.iso_code)
-            if city.continent and city.continent.code:
-                readable.append(city.continent.code)
-            event["ip_location"] = ", ".join(readable)
-            x, y, z = latlon_to_xyz(city.location.latitude, city.location.longitude)
-            try:
-                asn = asn_lookup.asn(event[ip_field]).autonomous_system_organization
-                event["asn"] = asn
-            except geoip2.errors.AddressNotFoundError:
-                asn = ""
-            if not asn:
-                asn = ""
-            processed.append([ts, event, user, x, y, z, asn, user_agent])
-    return sorted(processed, key=lambda event: event[0])
+            # Events stored later can share the high-water timestamp, only
+            # the ones that are already cached are skipped.
+            if ts == high_water[module]:
+                digest = event_digest(event)
+                if boundary[module][digest]:
+                    boundary[module][digest] -= 1
+                    continue
+            fresh.append((event, ts))
+        kept, times = [event for event, ts in fresh], [ts for event, ts in fresh]
+    # Users, user agents and addresses repeat a lot, so each distinct value is
+    # only mapped, filtered or looked up once.
+    users = {}
+    for raw_user in set(event[user_field] for event in kept):
+        user = raw_user
+        if "user_map" in settings and raw_user in settings["user_map"]:
+            user = settings["user_map"][raw_user]
+        if "user_domain" in settings and '@' not in user:
+            user = "@".join((user, settings["user_domain"]))
+        users[raw_user] = user
+    user_agents = {user_agent: UA_FILTER.sub('', user_agent)
+                   for user_agent in set(event[ua_field] for event in kept)}
+    locations = geo_lookup_all(config, [event[ip_field] for event in kept])
+    rows = []
+    for ts, event in zip(times, kept):
+        location, x, y, z, asn = locations[event[ip_field]]
+        event["ip_location"] = location
+        if asn is not None:
+            event["asn"] = asn
+        if not asn:
+            asn = ""
+        rows.append([ts, event, users[event[user_field]], x, y, z, asn, user_agents[event[ua_field]], module])
+    return rows
+
+
+def log_geoip_cache(config):
+    logger.debug("GeoIP cache: %s hits, %s misses, %s entries." %
+                 (geoip_state["hits"], geoip_state["misses"], len(geoip_state["cache"])))
+    save_geoip_cache(config)
+
+
+def parse_timestamp(value):
+    if isinstance(value, str) and "T" in value:
+        return datetime.timestamp(datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%fZ'))
+    return value
+
+
+def parse_timestamps(values):
+    import numpy
+    # Same results as parse_timestamp() for every value. numpy parses the ISO
+    # strings as naive times, which are then shifted by the local UTC offset.
+    # The offset is looked up once per hour, with datetime.timestamp() itself,
+    # and only hours that contain a DST change are converted one by one.
+    parsed = list(values)
+    iso = [i for i, value in enumerate(values) if isinstance(value, str) and "T" in value]
+    exact = [i for i in iso if not ISO_TIMESTAMP.fullmatch(values[i])]
+    for i in exact:
+        parsed[i] = parse_timestamp(values[i])
+    if len(exact) < len(iso):
+        iso = [i for i in iso if ISO_TIMESTAMP.fullmatch(values[i])]
+        micros = numpy.array([values[i][:-1] for i in iso], dtype="datetime64[us]").astype(numpy.int64)
+        seconds = micros // 1000000
+        epoch = datetime(1970, 1, 1)
+        offsets = {}
+        for hour in numpy.unique(seconds // 3600).tolist():
+            first = hour * 3600
+            start = first - int(datetime.timestamp(epoch + timedelta(seconds=first)))
+            end = first + 3599 - int(datetime.timestamp(epoch + timedelta(seconds=first + 3599)))
+            offsets[hour] = start if start == end else None
+        shift = numpy.array([offsets[hour] or 0 for hour in (seconds // 3600).tolist()], dtype=numpy.int64)
+        converted = ((seconds - shift).astype(numpy.float64) + (micros % 1000000) / 1e6).tolist()
+        for n, i in enumerate(iso):
+            if offsets[int(seconds[n]) // 3600] is None:
+                parsed[i] = parse_timestamp(values[i])
+            else:
+                parsed[i] = converted[n]
+    return parsed
+
+
+def history_start(config, module):
+    if "analysis" not in config or "history_limit" not in config["analysis"] or \
+       not config["analysis"]["history_limit"]:
+        return 0
+    if "last_polled" not in config or module not in config["last_polled"]:
+        return 0
+    last_time = float(parse_timestamp(config["last_polled"][module]["last_polled_time"]))
+    return max(0, last_time - float(config["analysis"]["history_limit"]))
+
+
+def read_start(config, module):
+    start = history_start(config, module)
+    # Events up to the high-water mark are already in the event cache.
+    if "cache_high_water" in config and module in config["cache_high_water"]:
+        start = max(start, config["cache_high_water"][module])
+    # Analysis engines that keep their own state have seen everything before
+    # their floor.
+    engine = analysis_engine(config)
+    if engine and hasattr(engine, "history_floor"):
+        start = max(start, engine.history_floor(config))
+    return start
+
+
+def checkpoint_name(config):
+    # Each analysis shard tracks its own progress.
+    if "shard" in config and config["shard"]:
+        return "last_analyzed.%s-of-%s" % tuple(config["shard"])
+    return "last_analyzed"
+
+
+def geoip_readers(config):
+    import geoip2.database
+    import maxminddb
+    # Readers are opened once per process and shared by every module.
+    if not geoip_state["readers"]:
+        city_lookup = geoip2.database.Reader(config["analysis"]["geoip"]["city_db"],
+                                             mode=maxminddb.MODE_MMAP)
+        asn_lookup = geoip2.database.Reader(config["analysis"]["geoip"]["asn_db"],
+                                            mode=maxminddb.MODE_MMAP)
+        geoip_state["readers"] = (city_lookup, asn_lookup)
+        geoip_state["builds"] = [city_lookup.metadata().build_epoch,
+                                 asn_lookup.metadata().build_epoch]
+        if "cache_size" in config["analysis"]["geoip"] and config["analysis"]["geoip"]["cache_size"]:
+            geoip_state["size"] = int(config["analysis"]["geoip"]["cache_size"])
+        load_geoip_cache(config)
+    return geoip_state["readers"]
+
+
+def reset_geoip():
+    if geoip_state["readers"]:
+        for reader in geoip_state["readers"]:
+            reader.close()
+    geoip_state["readers"] = None
+    geoip_state["builds"] = None
+    geoip_state["cache"].clear()
+
+
+def geo_lookup(config, ip):
+    return geo_lookup_all(config, [ip])[ip]
+
+
+def geo_lookup_all(config, ips):
+    import numpy
+    import geoip2.errors
+    cache = geoip_state["cache"]
+    results = {}
+    misses = []
+    for ip in ips:
+        if ip in results:
+            continue
+        if ip in cache:
+            cache.move_to_end(ip)
+            results[ip] = cache[ip]
+        else:
+            results[ip] = None
+            misses.append(ip)
+    geoip_state["hits"] += len(ips) - len(misses)
+    geoip_state["misses"] += len(misses)
+    if not misses:
+        return results
+    city_lookup, asn_lookup = geoip_readers(config)
+    found = []
+    for ip in misses:
+        city = city_lookup.city(ip)
+        readable = []
+        if "en" in city.city.names and city.city.names["en"]:
+            readable.append(city.city.names["en"])
+        if city.subdivisions and city.subdivisions[0].iso_code:
+            readable.append(city.subdivisions[0].iso_code)
+        if city.country and city.country.iso_code:
+            readable.append(city.country.iso_code)
+        if city.continent and city.continent.code:
+            readable.append(city.continent.code)
+        try:
+            asn = asn_lookup.asn(ip).autonomous_system_organization
+        except geoip2.errors.AddressNotFoundError:
+            asn = None
+        found.append((", ".join(readable), city.location.latitude, city.location.longitude, asn))
+    x, y, z = latlon_to_xyz(numpy.array([entry[1] for entry in found], dtype=numpy.float64),
+                            numpy.array([entry[2] for entry in found], dtype=numpy.float64))
+    for n, ip in enumerate(misses):
+        results[ip] = (found[n][0], float(x[n]), float(y[n]), float(z[n]), found[n][3])
+        cache[ip] = results[ip]
+        if len(cache) > geoip_state["size"]:
+            cache.popitem(last=False)
+    return results
+
+
+def load_geoip_cache(config):
+    if "cache_file" not in config["analysis"]["geoip"] or not config["analysis"]["geoip"]["cache_file"]:
+        return
+    cache_file = Path(config["analysis"]["geoip"]["cache_file"])
+    if not cache_file.is_file():
+        return
+    with cache_file.open('r') as f:
+        try:
+            saved = json.load(f)
+        except ValueError:
+            logger.warning("Ignoring unreadable GeoIP cache file %s." % cache_file)
+            return
+    # Entries are only valid for the databases they were looked up in.
+    if saved["builds"] != geoip_state["builds"]:
+        logger.debug("GeoIP databases changed, discarding the cache file.")
+        return
+    for ip, result in saved["entries"][-geoip_state["size"]:]:
+        geoip_state["cache"][ip] = tuple(result)
+    logger.debug("Loaded %s GeoIP cache entries." % len(geoip_state["cache"]))
+
+
+def save_geoip_cache(config):
+    if "geoip" not in config["analysis"] or "cache_file" not in config["analysis"]["geoip"] or \
+       not config["analysis"]["geoip"]["cache_file"] or not geoip_state["readers"]:
+        return
+    cache_file = Path(config["analysis"]["geoip"]["cache_file"])
+    tmp_file = cache_file.with_suffix(".tmp")
+    with tmp_file.open('w') as f:
+        json.dump({"builds": geoip_state["builds"],
+                   "entries": list(geoip_state["cache"].items())}, f)
+    tmp_file.replace(cache_file)
+
+
+def group_events(data, store=None):
+    import numpy
+    # Single pass over the sorted rows (a list or a stream): every user gets
+    # columnar slices, and the ASN/UA strings are interned so each slice only
+    # carries integer codes. Passing an existing store extends it in place.
+    if store is None:
+        store = {"asn_codes": {}, "ua_codes": {}, "users": {}, "last": None, "fetch": None}
+    asn_codes = store["asn_codes"]
+    ua_codes = store["ua_codes"]
+    columns = {}
+    for ts, event, user, x, y, z, asn, user_agent, module in data:
+        store["last"] = ts if store["last"] is None else max(store["last"], ts)
+        if user not in columns:
+            columns[user] = ([], [], [], [], [])
+        times, coords, asns, uas, events = columns[user]
+        times.append(ts)
+        coords.append((x, y, z))
+        asns.append(asn_codes.setdefault(asn, len(asn_codes)))
+        uas.append(ua_codes.setdefault(user_agent, len(ua_codes)))
+        events.append(event)
+    store["asns"] = numpy.array(list(asn_codes), dtype=object)
+    store["uas"] = numpy.array(list(ua_codes), dtype=object)
+    for user, (times, coords, asns, uas, events) in columns.items():
+        user_events = UserEvents(numpy.array(times, dtype=numpy.float64),
+                                 numpy.array(coords, dtype=numpy.float64).reshape(-1, 3),
+                                 numpy.array(asns, dtype=numpy.int32),
+                                 numpy.array(uas, dtype=numpy.int32),
+                                 events)
+        if user in store["users"]:
+            user_events = merge_user_events(store["users"][user], user_events)
+        store["users"][user] = user_events
+    return store
+
+
+def merge_user_events(old, new):
+    import numpy
+    # Events are dicts, or offsets into the event cache.
+    if isinstance(old.events, list):
+        events = list(old.events) + list(new.events)
+    else:
+        events = numpy.concatenate((old.events, new.events))
+    merged = UserEvents(numpy.concatenate((old.times, new.times)),
+                        numpy.concatenate((old.xyz, new.xyz)),
+                        numpy.concatenate((old.asns, new.asns)),
+                        numpy.concatenate((old.uas, new.uas)),
+                        events)
+    if len(old.times) and len(new.times) and new.times[0] < old.times[-1]:
+        # Late events from another module, restore timestamp order.
+        order = numpy.argsort(merged.times, kind="stable")
+        if isinstance(events, list):
+            events = [events[i] for i in order]
+        else:
+            events = events[order]
+        merged = UserEvents(merged.times[order], merged.xyz[order], merged.asns[order],
+                            merged.uas[order], events)
+    return merged
+
+
+def trim_store(config, store, users):
+    import numpy
+    limits = [history_start(config, module) for module in config["active_modules"]["analysis"]]
+    limit = min(limits) if limits else 0
+    for user in users:
+        user_events = store["users"][user]
+        start = int(numpy.searchsorted(user_events.times, limit, side="left"))
+        if start:
+            store["users"][user] = UserEvents(user_events.times[start:], user_events.xyz[start:],
+                                              user_events.asns[start:], user_events.uas[start:],
+                                              user_events.events[start:])
+
+
+def event_cache_directory(config):
+    if "analysis" not in config or "event_cache" not in config["analysis"] or \
+       "directory" not in config["analysis"]["event_cache"] or \
+       not config["analysis"]["event_cache"]["directory"]:
+        return None
+    cache_dir = Path(config["analysis"]["event_cache"]["directory"])
+    cache_dir.mkdir(mode=0o775, parents=True, exist_ok=True)
+    return cache_dir
+
+
+@contextmanager
+def cache_lock(cache_dir):
+    # Appending and compacting rewrite the metadata and the files it
+    # describes, so runs in other processes have to wait for each other.
+    with (cache_dir / "cache.lock").open('a') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def cache_fingerprint(config):
+    # Cached rows are only valid for the settings they were preprocessed with.
+    settings = {"version": CACHE_VERSION}
+    for module in config["active_modules"]["analysis"]:
+        settings[module] = {}
+        for option in ("user_map", "user_domain"):
+            if option in config["analysis"][module]:
+                settings[module][option] = config["analysis"][module][option]
+    geoip_readers(config)
+    settings["geoip"] = geoip_state["builds"]
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def open_event_cache(cache_dir, meta):
+    import numpy
+    columns = {"meta": meta}
+    for name, (dtype, width) in CACHE_COLUMNS.items():
+        shape = (meta["rows"], width) if width > 1 else (meta["rows"],)
+        if meta["rows"]:
+            columns[name] = numpy.memmap(cache_dir / (name + ".bin"), dtype=dtype, mode="r", shape=shape)
+        else:
+            columns[name] = numpy.empty(shape, dtype=dtype)
+    return columns
+
+
+def load_event_cache(config):
+    cache_dir = event_cache_directory(config)
+    meta_file = cache_dir / "meta.json"
+    fingerprint = cache_fingerprint(config)
+    meta = None
+    if meta_file.is_file():
+        with meta_file.open('r') as f:
+            meta = json.load(f)
+        if meta["fingerprint"] != fingerprint:
+            logger.info("Preprocessing settings changed, rebuilding the event cache.")
+            meta = None
+    if meta is None:
+        meta = {"fingerprint": fingerprint, "rows": 0, "events_size": 0, "high_water": {}, "boundary": {},
+                "modules": [], "users": [], "asns": [], "uas": []}
+    return open_event_cache(cache_dir, meta)
+
+
+def append_event_cache(config, columns, data):
+    import numpy
+    cache_dir = event_cache_directory(config)
+    meta = columns["meta"]
+    tables = {}
+    for table in ("modules", "users", "asns", "uas"):
+        tables[table] = {value: code for code, value in enumerate(meta[table])}
+    new = {name: [] for name in CACHE_COLUMNS}
+    offset = meta["events_size"]
+    with (cache_dir / "events.jsonl").open('ab') as f:
+        # Anything past the committed size is left over from an interrupted run.
+        f.truncate(offset)
+        for ts, event, user, x, y, z, asn, user_agent, module in data:
+            line = ('%s\n' % json.dumps(event)).encode("utf-8")
+            f.write(line)
+            new["ts"].append(ts)
+            new["xyz"].append((x, y, z))
+            new["module"].append(tables["modules"].setdefault(module, len(tables["modules"])))
+            new["user"].append(tables["users"].setdefault(user, len(tables["users"])))
+            new["asn"].append(tables["asns"].setdefault(asn, len(tables["asns"])))
+            new["ua"].append(tables["uas"].setdefault(user_agent, len(tables["uas"])))
+            new["offset"].append(offset)
+            offset += len(line)
+            if module not in meta["high_water"] or ts > meta["high_water"][module]:
+                meta["high_water"][module] = ts
+                meta["boundary"][module] = []
+            if ts == meta["high_water"][module]:
+                meta["boundary"][module].append(event_digest(event))
+    if not new["ts"]:
+        return columns
+    for name, (dtype, width) in CACHE_COLUMNS.items():
+        with (cache_dir / (name + ".bin")).open('ab') as f:
+            f.truncate(meta["rows"] * width * numpy.dtype(dtype).itemsize)
+            numpy.array(new[name], dtype=dtype).tofile(f)
+    for table in tables:
+        meta[table] = list(tables[table])
+    meta["rows"] += len(new["ts"])
+    meta["events_size"] = offset
+    # The metadata is written last, so it only ever describes complete rows.
+    tmp_file = cache_dir / "meta.tmp"
+    with tmp_file.open('w') as f:
+        json.dump(meta, f)
+    tmp_file.replace(cache_dir / "meta.json")
+    logger.debug("Appended %s rows to the event cache, %s in total." % (len(new["ts"]), meta["rows"]))
+    return open_event_cache(cache_dir, meta)
+
+
+def event_digest(event):
+    # The same before and after preprocessing.
+    fields = {key: value for key, value in event.items() if key not in PREPROCESS_FIELDS}
+    return hashlib.sha1(json.dumps(fields, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def cached_event(config, offset):
+    with (event_cache_directory(config) / "events.jsonl").open('rb') as f:
+        f.seek(offset)
+        return json.loads(f.readline())
+
+
+def compact_event_cache(config):
+    import numpy
+    cache_dir = event_cache_directory(config)
+    with cache_lock(cache_dir):
+        columns = load_event_cache(config)
+        meta = columns["meta"]
+        limits = numpy.array([history_start(config, module) for module in meta["modules"]] or [0],
+                             dtype=numpy.float64)
+        rows = numpy.flatnonzero(columns["ts"] >= limits[columns["module"]])
+        if len(rows) == meta["rows"]:
+            return
+        # Until the new metadata is written the cache reads as empty, so an
+        # interrupted compaction only costs a rebuild.
+        (cache_dir / "meta.json").unlink()
+        offsets = numpy.empty(len(rows), dtype=CACHE_COLUMNS["offset"][0])
+        offset = 0
+        with (cache_dir / "events.jsonl").open('rb') as old, (cache_dir / "events.tmp").open('wb') as new:
+            for n, row in enumerate(rows):
+                old.seek(int(columns["offset"][row]))
+                line = old.readline()
+                new.write(line)
+                offsets[n] = offset
+                offset += len(line)
+        for name in CACHE_COLUMNS:
+            values = offsets if name == "offset" else columns[name][rows]
+            values.tofile(str(cache_dir / (name + ".tmp")))
+        del columns
+        (cache_dir / "events.tmp").replace(cache_dir / "events.jsonl")
+        for name in CACHE_COLUMNS:
+            (cache_dir / (name + ".tmp")).replace(cache_dir / (name + ".bin"))
+        logger.info("Removed %s rows from the event cache, %s left." % (meta["rows"] - len(rows), len(rows)))
+        meta["rows"] = len(rows)
+        meta["events_size"] = offset
+        tmp_file = cache_dir / "meta.tmp"
+        with tmp_file.open('w') as f:
+            json.dump(meta, f)
+        tmp_file.replace(cache_dir / "meta.json")
+
+
+def group_columns(config, columns, store=None):
+    import numpy
+    # Passing a store built from the same cache only adds the rows appended
+    # since, like group_events does.
+    meta = columns["meta"]
+    if store is None or "fingerprint" not in store or store["fingerprint"] != meta["fingerprint"] or \
+       store["rows"] > meta["rows"]:
+        store = {"users": {}, "last": None, "rows": 0, "fingerprint": meta["fingerprint"],
+                 "fetch": lambda offset: cached_event(config, offset)}
+    limits = numpy.array([history_start(config, module) for module in meta["modules"]] or [0],
+                         dtype=numpy.float64)
+    first = store["rows"]
+    rows = first + numpy.flatnonzero(columns["ts"][first:] >= limits[columns["module"][first:]])
+    order = rows[numpy.lexsort((columns["ts"][rows], columns["user"][rows]))]
+    store["asns"] = numpy.array(meta["asns"], dtype=object)
+    store["uas"] = numpy.array(meta["uas"], dtype=object)
+    store["rows"] = meta["rows"]
+    if len(rows):
+        last = float(columns["ts"][rows].max())
+        store["last"] = last if store["last"] is None else max(store["last"], last)
+    for chunk in numpy.split(order, numpy.flatnonzero(numpy.diff(columns["user"][order])) + 1):
+        if not len(chunk):
+            continue
+        user = meta["users"][columns["user"][chunk[0]]]
+        user_events = UserEvents(columns["ts"][chunk], columns["xyz"][chunk],
+                                 columns["asn"][chunk], columns["ua"][chunk],
+                                 columns["offset"][chunk])
+        if user in store["users"]:
+            user_events = merge_user_events(store["users"][user], user_events)
+        store["users"][user] = user_events
+    return store
+
+
+def build_store(config, data, store=None):
+    # With --stream this stage also covers reading and preprocessing the history.
+    with stage("build_store") as record:
+        if not event_cache_directory(config):
+            store = group_events(data, store)
+        else:
+            with cache_lock(event_cache_directory(config)):
+                columns = append_event_cache(config, load_event_cache(config), data)
+            store = group_columns(config, columns, store)
+        record["users"] = len(store["users"])
+    return store
+
+
+def fit_detector(features):
+    from sklearn.ensemble import IsolationForest
+    # Per-user matrices are small, so parallelism comes from spreading users
+    # across worker processes instead of threading a single forest.
+    detector = IsolationForest(n_jobs=1)
+    # The forest fits fastest on CSC and scores fastest on CSR.
+    detector.fit(features.tocsc())
+    # Equivalent of the old contamination=0: only flag events that are more
+    # isolated than anything in the training set.
+    detector.offset_ = detector.score_samples(features).min()
+    return detector
+
+
+def fit_model(user_events, asn_names, ua_names, end):
+    from scipy.sparse import csr_matrix, hstack
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    asn_vectorizer = TfidfVectorizer(binary=True)
+    ua_vectorizer = TfidfVectorizer(binary=True)
+    logger.debug("Transforming ASNs.")
+    asns = asn_vectorizer.fit_transform(asn_names[user_events.asns[:end]])
+    logger.debug("Transforming User-Agents.")
+    uas = ua_vectorizer.fit_transform(ua_names[user_events.uas[:end]])
+    features = hstack((csr_matrix(user_events.xyz[:end]), asns, uas), format="csr")
+    log_feature_memory(features)
+    logger.debug("Running Isolation Forest.")
+    model = {
+        "version": MODEL_VERSION,
+        "window": (float(user_events.times[0]), float(user_events.times[end - 1])),
+        "events": end,
+        "asn_vectorizer": asn_vectorizer,
+        "ua_vectorizer": ua_vectorizer,
+        "detector": fit_detector(features)
+    }
+    return model, features
+
+
+def model_features(model, user_events, asn_names, ua_names, start):
+    from scipy.sparse import csr_matrix, hstack
+    asns = model["asn_vectorizer"].transform(asn_names[user_events.asns[start:]])
+    uas = model["ua_vectorizer"].transform(ua_names[user_events.uas[start:]])
+    features = hstack((csr_matrix(user_events.xyz[start:]), asns, uas), format="csr")
+    log_feature_memory(features)
+    return features
+
+
+def log_feature_memory(features):
+    if logger.isEnabledFor(logging.DEBUG):
+        size = features.data.nbytes + features.indices.nbytes + features.indptr.nbytes
+        dense = features.shape[0] * features.shape[1] * features.dtype.itemsize
+        logger.debug("Feature matrix is %s x %s: %s bytes sparse, %s bytes dense." %
+                     (features.shape[0], features.shape[1], size, dense))
+
+
+def unseen_vocabulary(vectorizer, codes, names):
+    import numpy
+    analyzer = vectorizer.build_analyzer()
+    unseen = set()
+    for code in numpy.unique(codes):
+        if any(token not in vectorizer.vocabulary_ for token in analyzer(names[code])):
+            unseen.add(code)
+    return numpy.isin(codes, list(unseen))
 
 
-def analyze(config, data):
+def model_is_stale(config, model, user_events, asn_names, ua_names, cutoff):
+    import numpy
+    settings = config["analysis"]["model_cache"]
+    if model["version"] != MODEL_VERSION:
+        return True
+    times = user_events.times
+    window_end = model["window"][1]
+    if "max_age" in settings and settings["max_age"] and \
+       times[cutoff - 1] - window_end > float(settings["max_age"]):
+        logger.debug("Cached model is older than max_age.")
+        return True
+    start = int(numpy.searchsorted(times, window_end, side="right"))
+    if "max_drift" in settings and settings["max_drift"] and start < cutoff:
+        # Share of the events analyzed since training that use an ASN or user
+        # agent the cached vocabularies have never seen.
+        unseen = unseen_vocabulary(model["asn_vectorizer"], user_events.asns[start:cutoff], asn_names) | \
+            unseen_vocabulary(model["ua_vectorizer"], user_events.uas[start:cutoff], ua_names)
+        drift = unseen.sum() / (cutoff - start)
+        if drift > float(settings["max_drift"]):
+            logger.debug("Cached model drifted by %.2f." % drift)
+            return True
+    return False
+
+
+def model_cache(config):
+    if "analysis" not in config or "model_cache" not in config["analysis"]:
+        return None
+    if "persistence" not in config["active_modules"] or not config["active_modules"]["persistence"]:
+        return None
+    persist_module = getattr(sys.modules[config["active_modules"]["persistence"]],
+                             config["active_modules"]["persistence"])
+    if not hasattr(persist_module, "get_model") or not hasattr(persist_module, "persist_model"):
+        return None
+    return persist_module
+
+
+def analyze_user(config, user, user_events, asn_names, ua_names, last_analyzed):
+    import numpy
+    times = user_events.times
+    if last_analyzed > 0 and times[-1] < last_analyzed:
+        logger.debug("Skipping user as they have no non-analyzed events.")
+        return None
+    cutoff = 0
+    if last_analyzed > 0:
+        cutoff = int(numpy.searchsorted(times, last_analyzed, side="left"))
+    cache = model_cache(config)
+    model = None
+    if cutoff > 0 and cache:
+        model = cache.get_model(config, user)
+        if model and model_is_stale(config, model, user_events, asn_names, ua_names, cutoff):
+            model = None
+        elif model:
+            logger.debug("Scoring against cached model for window %s-%s." % model["window"])
+    if model is None:
+        if cutoff > 0:
+            logger.debug("Splitting array of length %s at entry %s" % (len(times), cutoff))
+        model, features = fit_model(user_events, asn_names, ua_names, cutoff or len(times))
+        if cache:
+            cache.persist_model(config, user, model)
+    if cutoff == 0:
+        predictions = model["detector"].predict(features)
+    else:
+        predictions = model["detector"].predict(model_features(model, user_events, asn_names,
+                                                               ua_names, cutoff))
+    return cutoff + numpy.flatnonzero(predictions == -1)
+
+
+def analysis_engine(config):
+    if "engine" not in config["active_modules"] or not config["active_modules"]["engine"]:
+        return None
+    return getattr(sys.modules[config["active_modules"]["engine"]], config["active_modules"]["engine"])
+
+
+def user_analyzer(config):
+    engine = analysis_engine(config)
+    if engine:
+        return engine.analyze_user
+    return analyze_user
+
+
+def in_shard(config, user):
+    if "shard" not in config or not config["shard"]:
+        return True
+    index, count = config["shard"]
+    return zlib.crc32(user.encode("utf-8")) % count == index
+
+
+def init_worker(config, asn_names, ua_names, last_analyzed):
+    # Workers started by spawn or forkserver have not imported the modules
+    # that analysis looks up in sys.modules.
+    for module in config["active_modules"]["analysis"]:
+        import_module(module)
+    for kind in ("persistence", "engine"):
+        if kind in config["active_modules"] and config["active_modules"][kind]:
+            import_module(config["active_modules"][kind])
+    worker_state["config"] = config
+    worker_state["asns"] = asn_names
+    worker_state["uas"] = ua_names
+    worker_state["last_analyzed"] = last_analyzed
+
+
+def analyze_worker(item):
+    user, user_events = item
+    started = time.perf_counter()
+    analyze_func = user_analyzer(worker_state["config"])
+    flagged = analyze_func(worker_state["config"], user, user_events, worker_state["asns"],
+                           worker_state["uas"], worker_state["last_analyzed"])
+    return user, flagged, time.perf_counter() - started
+
+
+def analyze_users(config, store, last_analyzed):
+    users = [user for user in store["users"] if in_shard(config, user)]
+    logger.debug("Users in shard: %s" % len(users))
+    workers = 1
+    if "workers" in config and config["workers"]:
+        workers = min(int(config["workers"]), max(1, len(users)))
+    if workers <= 1:
+        analyze_func = user_analyzer(config)
+        for user in users:
+            logger.debug("Analyzing data for user %s." % user)
+            started = time.perf_counter()
+            flagged = analyze_func(config, user, store["users"][user], store["asns"], store["uas"],
+                                   last_analyzed)
+            if flagged is not None:
+                run_metrics["users"].append((time.perf_counter() - started, user))
+            yield user, flagged
+        return
+    logger.debug("Analyzing users across %s worker processes." % workers)
+    # Event dicts stay in this process; workers only need the typed columns
+    # and hand back row indices.
+    slices = ((user, store["users"][user]._replace(events=None)) for user in users)
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(config, store["asns"], store["uas"], last_analyzed)) as executor:
+        for user, flagged, elapsed in executor.map(analyze_worker, slices,
+                                                   chunksize=max(1, len(users) // (workers * 4))):
+            if flagged is not None:
+                run_metrics["users"].append((elapsed, user))
+            yield user, flagged
+
+
+def analyze(config, store):
     alerts = []
     last_analyzed = 0
+    persist_analyzed_func = None
     if "persistence" in config["active_modules"] and config["active_modules"]["persistence"]:
         persist_module = getattr(sys.modules[config["active_modules"]["persistence"]],
                                  config["active_modules"]["persistence"])
         last_analyzed_func = getattr(persist_module, "get_last_analyzed")
         persist_analyzed_func = getattr(persist_module, "persist_last_analyzed")
         last_analyzed = last_analyzed_func(config)
-    # get unique list of users across data
-    unique_users = list(set([e[2] for e in data]))
-    logger.debug("Unique users: %s" % len(unique_users))
-    for user in unique_users:
-        logger.debug("Analyzing data for user %s." % user)
-        user_events = numpy.array([e for e in data if e[2] == user])
-        if last_analyzed > 0 and user_events[-1][0] < last_analyzed:
-            logger.debug("Skipping user as they have no non-analyzed events.")
-            continue
-        asn_vectorizer = TfidfVectorizer(binary=True)
-        ua_vectorizer = TfidfVectorizer(binary=True)
-        times = user_events[:, 0:1]
-        coords = user_events[:, 3:6]
-        logger.debug("Transforming ASNs.")
-        asns = asn_vectorizer.fit_transform(user_events[:, 6])
-        logger.debug("Transforming User-Agents.")
-        uas = ua_vectorizer.fit_transform(user_events[:, 7])
-        sparse_mat = numpy.concatenate((times, coords, asns.toarray(), uas.toarray()), axis=1)
-        logger.debug("Running Isolation Forest.")
-        detector = IsolationForest(n_jobs=-1, contamination=0)
-        if last_analyzed == 0 or user_events[0][0] >= last_analyzed:
-            detector.fit(sparse_mat[:, 1:])
-            predictions = detector.predict(sparse_mat[:, 1:])
-        else:
-            for counter, event in enumerate(sparse_mat):
-                if event[0] < last_analyzed:
-                    cutoff = counter
+    logger.debug("Unique users: %s" % len(store["users"]))
+    with stage("analyze") as record:
+        for user, flagged in analyze_users(config, store, last_analyzed):
+            # Release each user's slice once it has been analyzed.
+            user_events = store["users"].pop(user)
+            if flagged is None:
+                continue
+            record["users"] += 1
+            record["events"] += len(user_events.times)
+            for ev_no in flagged:
+                if store["fetch"]:
+                    alert = store["fetch"](user_events.events[ev_no])
                 else:
-                    break
-            cutoff += 1
-            logger.debug("Splitting array of length %s at entry %s" % (len(sparse_mat), cutoff))
-            detector.fit(sparse_mat[:cutoff, 1:])
-            predictions = detector.predict(sparse_mat[cutoff:, 1:])
-        flagged = 0
-        for ev_no, prediction in enumerate(predictions):
-            if prediction == -1:
-                flagged += 1
-                alerts.append(user_events[ev_no][1])
-        logger.debug("Processed %s: %s of %s flagged." % (user, flagged, len(user_events)))
+                    alert = user_events.events[ev_no]
+                # Lets notifiers group alerts without knowing every module's fields.
+                alert["alert_user"] = user
+                alert["alert_time"] = float(user_events.times[ev_no])
+                alerts.append(alert)
+            logger.debug("Processed %s: %s of %s flagged." % (user, len(flagged), len(user_events.times)))
+        record["alerts"] = len(alerts)
     if "notifiers" in config["active_modules"]:
         for module in config["active_modules"]["notifiers"]:
             notify_mod = getattr(sys.modules[module], module)
             notify_func = getattr(notify_mod, "notify")
-            notify_func(config, alerts)
+            with stage("notify." + module) as record:
+                notify_func(config, alerts)
+                record["alerts"] = len(alerts)
     else:
         for alert in alerts:
             logger.info(alert)
-    persist_analyzed_func(config, data[-1][0])
+    if persist_analyzed_func and store["last"] is not None:
+        persist_analyzed_func(config, store["last"])
+        engine = analysis_engine(config)
+        if engine and hasattr(engine, "analyzed"):
+            engine.analyzed(config, store["last"])
 
 
 def latlon_to_xyz(lat, lon):
+    import numpy
     phi = (90 - lat) * (numpy.pi / 180)
     theta = (lon + 180) * (numpy.pi / 180)
 
@@ -178,6 +986,390 @@ def latlon_to_xyz(lat, lon):
     return (x, y, z)
 
 
+def poll_interval(config, poller):
+    if poller in config["pollers"] and config["pollers"][poller] and \
+       "interval" in config["pollers"][poller] and config["pollers"][poller]["interval"]:
+        return float(config["pollers"][poller]["interval"])
+    return DEFAULT_POLL_INTERVAL
+
+
+def start(args):
+    started = time.perf_counter()
+    config = load_config(args.config)
+    startup_profile["stages"]["load config"] = time.perf_counter() - started
+    config["mode"] = args.mode
+    config["workers"] = args.workers
+    config["shard"] = args.shard
+    config["checkpoint"] = checkpoint_name(config)
+    config["stream"] = args.stream
+    started = time.perf_counter()
+    config = load_modules(config)
+    startup_profile["stages"]["load modules"] = time.perf_counter() - started
+    logger.info("Modules and config loaded.")
+    return config
+
+
+def run_once(args):
+    reset_metrics()
+    config = start(args)
+    try:
+        run_stages(config, args)
+    finally:
+        write_metrics(config)
+
+
+def run_stages(config, args):
+    if args.mode == "migrate":
+        if "persistence" not in config["active_modules"]:
+            raise RuntimeError("Migration requested, but no persistence module configured.")
+        persist_module = getattr(sys.modules[config["active_modules"]["persistence"]],
+                                 config["active_modules"]["persistence"])
+        logger.info("Migrating stored data...")
+        getattr(persist_module, "migrate")(config)
+    if args.mode == "compact":
+        compact(config)
+    if not args.mode or args.mode == "poll":
+        logger.info("Polling for new events...")
+        data = poll(config)
+    if not args.mode or args.mode == "analyze":
+        if "persistence" in config and config["persistence"]:
+            logger.info("Loading stored data...")
+            data = load_historical(config)
+        logger.info("Preprocessing data...")
+        if args.stream:
+            data = preprocess_stream(config, data)
+        else:
+            data = preprocess(config, data)
+        store = build_store(config, data)
+        logger.info("Analyzing data...")
+        analyze(config, store)
+
+
+def compact(config):
+    if "persistence" not in config["active_modules"]:
+        raise RuntimeError("Compaction requested, but no persistence module configured.")
+    persist_module = getattr(sys.modules[config["active_modules"]["persistence"]],
+                             config["active_modules"]["persistence"])
+    if not hasattr(persist_module, "compact"):
+        raise RuntimeError("Persistence module %s does not support compaction." %
+                           config["active_modules"]["persistence"])
+    logger.info("Compacting stored data...")
+    with stage("compact"):
+        config = getattr(persist_module, "get_last")(config)
+        # Events before the start of the history window may go.
+        config["window_start"] = {module: history_start(config, module) for module in config["last_polled"]}
+        getattr(persist_module, "compact")(config)
+        if event_cache_directory(config):
+            compact_event_cache(config)
+
+
+def compact_interval(config):
+    if "persistence" in config and config["persistence"] and \
+       "compact_interval" in config["persistence"] and config["persistence"]["compact_interval"]:
+        return float(config["persistence"]["compact_interval"])
+    return None
+
+
+def retry_delay(failures):
+    return min(RETRY_DELAY * 2 ** (failures - 1), MAX_RETRY_DELAY)
+
+
+def daemon(args):
+    state = {"running": True, "reload": False}
+    wake = threading.Event()
+
+    def request_reload(signum, frame):
+        state["reload"] = True
+        wake.set()
+
+    def request_stop(signum, frame):
+        state["running"] = False
+        wake.set()
+
+    signal.signal(signal.SIGHUP, request_reload)
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    config = start(args)
+    store = None
+    next_poll = {}
+    failures = {}
+    next_compact = time.time()
+    while state["running"]:
+        if state["reload"]:
+            logger.info("Reloading configuration...")
+            state["reload"] = False
+            config = start(args)
+            reset_geoip()
+            store = None
+            next_poll = {}
+            failures = {}
+            next_compact = time.time()
+        now = time.time()
+        if compact_interval(config) and next_compact <= now:
+            next_compact = now + compact_interval(config)
+            try:
+                # Runs between polls, so it never races the daemon's own writes.
+                compact(config)
+            except Exception:
+                logger.exception("Compaction failed, retrying at the next interval.")
+            if event_cache_directory(config):
+                # Compaction moved the cached rows the warm store points into.
+                store = None
+        due = [poller for poller in config["active_modules"]["pollers"]
+               if poller not in next_poll or next_poll[poller] <= now]
+        if due:
+            reset_metrics()
+            errors = {}
+            try:
+                data = poll(config, due, errors)
+            except Exception:
+                # Persisting failed, so nothing of this cycle was stored.
+                logger.exception("Polling failed.")
+                data = {}
+                errors = {poller: None for poller in due}
+            for poller in due:
+                if poller in errors:
+                    failures[poller] = failures.get(poller, 0) + 1
+                    next_poll[poller] = now + retry_delay(failures[poller])
+                    logger.warning("Retrying %s in %d seconds." % (poller, next_poll[poller] - now))
+                else:
+                    failures.pop(poller, None)
+                    next_poll[poller] = now + poll_interval(config, poller)
+            new = {module: data[module] for module in data
+                   if module in config["active_modules"]["analysis"] and data[module]}
+            try:
+                if store is None:
+                    # Only the first cycle reads the stored history, later ones just
+                    # add what was polled to the warm store.
+                    if "persistence" in config["active_modules"]:
+                        logger.info("Loading stored data...")
+                        new = load_historical(config)
+                    store = build_store(config, preprocess(config, new))
+                elif new:
+                    rows = preprocess(config, new)
+                    store = build_store(config, rows, store)
+                    trim_store(config, store, set([row[2] for row in rows]))
+                else:
+                    logger.info("No new events.")
+                    write_metrics(config)
+                    continue
+                logger.info("Analyzing data...")
+                # analyze() releases the users it is done with, so it gets its own view.
+                analyze(config, dict(store, users=dict(store["users"])))
+                if hasattr(analysis_engine(config), "history_floor"):
+                    # The engine remembers what it has seen, so the next cycle only
+                    # needs to read back what was stored since.
+                    store = None
+            except Exception:
+                # The warm store may be half updated, the next cycle rereads
+                # the stored history instead.
+                logger.exception("Analysis failed.")
+                store = None
+            write_metrics(config)
+        deadlines = list(next_poll.values())
+        if compact_interval(config):
+            deadlines.append(next_compact)
+        wake.wait(max(0, min(deadlines) - time.time()))
+        wake.clear()
+    logger.info("Daemon stopped.")
+
+
+def reset_metrics():
+    run_metrics["started"] = time.time()
+    run_metrics["stages"].clear()
+    del run_metrics["users"][:]
+
+
+def cpu_time():
+    # Includes worker processes once they have been joined.
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def max_rss(who=resource.RUSAGE_SELF):
+    # Linux reports kilobytes, macOS bytes.
+    return resource.getrusage(who).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+
+@contextmanager
+def stage(name):
+    record = Counter()
+    started = time.perf_counter()
+    cpu_started = cpu_time()
+    try:
+        yield record
+    finally:
+        with metrics_lock:
+            entry = run_metrics["stages"].setdefault(name, {"runs": 0, "wall_seconds": 0.0,
+                                                            "cpu_seconds": 0.0})
+            entry["runs"] += 1
+            entry["wall_seconds"] += time.perf_counter() - started
+            entry["cpu_seconds"] += cpu_time() - cpu_started
+            for key, value in record.items():
+                entry[key] = entry.get(key, 0) + value
+            entry["max_rss_bytes"] = max_rss()
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def metrics_summary(config):
+    timings = sorted(run_metrics["users"])
+    seconds = [elapsed for elapsed, user in timings]
+    summary = {
+        "version": program_version,
+        "mode": config["mode"] or "once",
+        "started": run_metrics["started"],
+        "finished": time.time(),
+        "max_rss_bytes": max_rss(),
+        "workers_max_rss_bytes": max_rss(resource.RUSAGE_CHILDREN),
+        "stages": run_metrics["stages"],
+        "user_analysis": {
+            "count": len(timings),
+            "seconds": sum(seconds),
+            "p50_seconds": percentile(seconds, 0.5),
+            "p95_seconds": percentile(seconds, 0.95),
+            "max_seconds": percentile(seconds, 1.0),
+            "slowest": [{"user": user, "seconds": elapsed} for elapsed, user in timings[-10:][::-1]]
+        },
+        "geoip": {
+            "hits": geoip_state["hits"],
+            "misses": geoip_state["misses"],
+            "cached": len(geoip_state["cache"])
+        },
+        "modules": {}
+    }
+    modules = list(config["active_modules"]["pollers"])
+    if "notifiers" in config["active_modules"]:
+        modules.extend(config["active_modules"]["notifiers"])
+    if "persistence" in config["active_modules"]:
+        modules.append(config["active_modules"]["persistence"])
+    for module in modules:
+        module_stats = getattr(getattr(sys.modules[module], module), "stats", None)
+        if module_stats and module not in summary["modules"]:
+            summary["modules"][module] = json.loads(json.dumps(module_stats))
+    return summary
+
+
+def prometheus_metrics(summary):
+    families = OrderedDict()
+
+    def add(family, kind, text, value, **labels):
+        if family not in families:
+            families[family] = (kind, text, [])
+        label_text = ",".join('%s="%s"' % (key, str(label).replace("\\", "\\\\").replace('"', '\\"'))
+                              for key, label in sorted(labels.items()))
+        families[family][2].append("%s%s %s" % (family, "{%s}" % label_text if label_text else "", value))
+
+    add("busybody_info", "gauge", "Busybody version and run mode.", 1,
+        version=summary["version"], mode=summary["mode"])
+    add("busybody_run_start_time_seconds", "gauge", "Start of the last run.", summary["started"])
+    add("busybody_run_duration_seconds", "gauge", "Wall time of the last run.",
+        summary["finished"] - summary["started"])
+    add("busybody_max_rss_bytes", "gauge", "Peak resident memory.", summary["max_rss_bytes"],
+        process="main")
+    add("busybody_max_rss_bytes", "gauge", "Peak resident memory.", summary["workers_max_rss_bytes"],
+        process="workers")
+    for name, entry in summary["stages"].items():
+        for key, value in entry.items():
+            if key == "max_rss_bytes":
+                continue
+            add("busybody_stage_" + key, "gauge", "Per-stage %s of the last run." % key.replace("_", " "),
+                value, stage=name)
+    users = summary["user_analysis"]
+    for quantile, key in (("0.5", "p50_seconds"), ("0.95", "p95_seconds")):
+        add("busybody_user_analysis_seconds", "summary", "Time spent fitting and scoring one user.",
+            users[key], quantile=quantile)
+    families["busybody_user_analysis_seconds"][2].extend([
+        "busybody_user_analysis_seconds_sum %s" % users["seconds"],
+        "busybody_user_analysis_seconds_count %s" % users["count"]])
+    add("busybody_geoip_lookups_total", "counter", "GeoIP lookups by cache result.",
+        summary["geoip"]["hits"], result="hit")
+    add("busybody_geoip_lookups_total", "counter", "GeoIP lookups by cache result.",
+        summary["geoip"]["misses"], result="miss")
+    for module, module_stats in sorted(summary["modules"].items()):
+        for key, value in sorted(module_stats.items()):
+            name = "busybody_module_%s_total" % key
+            text = "Counted by the module since busybody started."
+            if isinstance(value, dict):
+                for label, count in sorted(value.items()):
+                    add(name, "counter", text, count, module=module, name=label)
+            else:
+                add(name, "counter", text, value, module=module)
+    lines = []
+    for name, (kind, text, samples) in families.items():
+        lines.append("# HELP %s %s" % (name, text))
+        lines.append("# TYPE %s %s" % (name, kind))
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics(config):
+    if "metrics" not in config or not config["metrics"] or run_metrics["started"] is None:
+        return
+    summary = metrics_summary(config)
+    outputs = []
+    if "json_file" in config["metrics"] and config["metrics"]["json_file"]:
+        outputs.append((Path(config["metrics"]["json_file"]), json.dumps(summary, indent=2) + "\n"))
+    if "prometheus_file" in config["metrics"] and config["metrics"]["prometheus_file"]:
+        outputs.append((Path(config["metrics"]["prometheus_file"]), prometheus_metrics(summary)))
+    for metrics_file, content in outputs:
+        # Written aside and renamed, so a collector never reads half a file.
+        tmp_file = metrics_file.with_name(metrics_file.name + ".tmp")
+        with tmp_file.open('w') as f:
+            f.write(content)
+        tmp_file.replace(metrics_file)
+    logger.debug("Run metrics: %s" % json.dumps(summary["stages"]))
+
+
+def profile_imports():
+    startup_profile["enabled"] = True
+    # Everything up to here (interpreter start and the core imports) has run
+    # on this process' CPU clock.
+    startup_profile["core"] = time.process_time()
+    original_import = builtins.__import__
+
+    def timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+        if level or name in sys.modules:
+            return original_import(name, globals, locals, fromlist, level)
+        return timed(original_import, name, globals, locals, fromlist, level)
+
+    builtins.__import__ = timed_import
+
+
+def import_module(name):
+    if startup_profile["enabled"] and name not in sys.modules:
+        return timed(importlib.import_module, name, name)
+    return importlib.import_module(name, name)
+
+
+def timed(import_func, name, *args):
+    depth = getattr(import_depth, "value", 0)
+    import_depth.value = depth + 1
+    started = time.perf_counter()
+    try:
+        return import_func(name, *args)
+    finally:
+        import_depth.value = depth
+        if depth == 0:
+            imports = startup_profile["imports"]
+            imports[name] = imports.get(name, 0) + time.perf_counter() - started
+
+
+def startup_report():
+    lines = ["Startup profile (seconds):",
+             "  %-40s %8.3f" % ("interpreter and core imports (CPU)", startup_profile["core"])]
+    for stage, elapsed in startup_profile["stages"].items():
+        lines.append("  %-40s %8.3f" % (stage, elapsed))
+    lines.append("  imports:")
+    for name, elapsed in sorted(startup_profile["imports"].items(), key=lambda item: -item[1]):
+        lines.append("    %-38s %8.3f" % (name, elapsed))
+    return "\n".join(lines)
+
+
 def load_config(config_path):
     if config_path:
         config_file = Path(config_path)
@@ -201,25 +1393,47 @@ def load_modules(config):
         raise RuntimeError("Polllers aren't optional.")
     config["active_modules"]["pollers"] = []
     for poller in config["pollers"]:
-        importlib.import_module(poller, poller)
+        import_module(poller)
         config["active_modules"]["pollers"].append(poller)
-    if config["mode"] is None or config["mode"] == "analyze":
+    config["active_modules"]["analysis"] = []
+    if "analysis" in config and config["analysis"]:
+        for module in config["analysis"]:
+            if module in ANALYSIS_SETTINGS:
+                continue
+            import_module(module)
+            config["active_modules"]["analysis"].append(module)
+        if "engine" in config["analysis"] and config["analysis"]["engine"]:
+            if "module" not in config["analysis"]["engine"] or not config["analysis"]["engine"]["module"]:
+                raise RuntimeError("An analysis engine is configured, but no module specified.")
+            if config["analysis"]["engine"]["module"] != BATCH_ENGINE:
+                import_module(config["analysis"]["engine"]["module"])
+                config["active_modules"]["engine"] = config["analysis"]["engine"]["module"]
+    if config["mode"] is None or config["mode"] in ("analyze", "daemon"):
         if "notifiers" not in config or not config["notifiers"]:
             raise RuntimeError("Configured to analyze, but no notifiers in config file.")
         config["active_modules"]["notifiers"] = []
         for notifier in config["notifiers"]:
-            importlib.import_module(notifier, notifier)
+            import_module(notifier)
             config["active_modules"]["notifiers"].append(notifier)
     if "persistence" in config and config["persistence"]:
         if "module" in config["persistence"] and config["persistence"]["module"]:
-            importlib.import_module(config["persistence"]["module"],
-                                    config["persistence"]["module"])
+            import_module(config["persistence"]["module"])
             config["active_modules"]["persistence"] = config["persistence"]["module"]
         else:
             raise RuntimeError("Persistence is configured, but no module specified.")
     return config
 
 
+def parse_shard(value):
+    try:
+        index, count = [int(part) for part in value.split("/")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("Shards must be given as INDEX/COUNT, e.g. 0/4.")
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError("Shard index must be between 0 and COUNT - 1.")
+    return (index, count)
+
+
 # INIT STUFF/CONTROL LOOP
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(prog="Busybody",
@@ -229,7 +1443,22 @@ if __name__ == '__main__':
     parser.add_argument("-f", "--file", default=None,
                         help="File to redirect log output into.")
     parser.add_argument("-m", "--mode", default=None,
-                        help="Select a mode from: poll, analyze. Default is to perform both.")
+                        help="Select a mode from: poll, analyze, daemon, migrate, compact. Default is to " +
+                             "perform both poll and analyze once. Daemon keeps running, polling on a " +
+                             "schedule and analyzing new events as they arrive. Migrate " +
+                             "upgrades the stored data to the current format of the " +
+                             "persistence module. Compact compresses stored data and removes " +
+                             "what is older than the history limit.")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="Number of processes used to analyze users in parallel. (Default: 1)")
+    parser.add_argument("-s", "--shard", type=parse_shard, default=None,
+                        help="Only analyze users in shard INDEX/COUNT (zero-based), " +
+                             "so that several hosts can split the user space.")
+    parser.add_argument("--stream", action="store_true",
+                        help="Stream stored events through preprocessing instead of loading " +
+                             "the whole history into memory first.")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="Report how long startup and every lazily imported dependency took.")
     parser.add_argument("-v", "--verbose", action="count", default=0,
                         help="Increase log verbosity level. (Default" +
                              " level: WARN, use twice for DEBUG)")
@@ -244,25 +1473,18 @@ if __name__ == '__main__':
     else:
         logging.basicConfig(level=loglevel, format=logformat)
 
+    if args.profile_startup:
+        profile_imports()
     logger.info("Starting busybody...")
     try:
-        config = load_config(args.config)
-        config["mode"] = args.mode
-        config = load_modules(config)
-        logger.info("Modules and config loaded.")
-        if not args.mode or args.mode == "poll":
-            logger.info("Polling for new events...")
-            data = poll(config)
-        if not args.mode or args.mode == "analyze":
-            if "persistence" in config and config["persistence"]:
-                logger.info("Loading stored data...")
-                data = load_historical(config)
-            logger.info("Preprocessing data...")
-            data = preprocess(config, data)
-            logger.info("Analyzing data...")
-            analyze(config, data)
+        if args.mode == "daemon":
+            daemon(args)
+        else:
+            run_once(args)
     except Exception as e:
         raise(e)
     finally:
+        if args.profile_startup:
+            sys.stderr.write(startup_report() + "\n")
         logger.info("Busybody closing.")
         logging.shutdown()
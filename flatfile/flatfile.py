@@ -1,17 +1,226 @@
+import os
 import sys
+import gzip
+import fcntl
 import json
+import shutil
+import pickle
+import itertools
+import hashlib
 import logging
 from pathlib import Path
-from datetime import datetime
+from datetime import datetime, timezone
+from contextlib import contextmanager
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 logger = logging.getLogger(__name__)
 
+INDEX_FILE = "index.json"
+LOCK_FILE = "index.lock"
+SEGMENT_SUFFIX = ".log"
+COMPRESSED_SUFFIX = ".log.gz"
+COMPRESS_BATCH = 10000
+TAIL_CHUNK = 4096
+# Times a reader reloads the index when a day's segment went missing under it.
+OPEN_ATTEMPTS = 3
+FSYNC_POLICIES = ("always", "never")
 
-def get_last(config):
+
+def log_directory(config):
     if "log_directory" not in config["persistence"] or not config["persistence"]["log_directory"]:
         raise RuntimeError("Flat file persistence requested, but no log_directory specified.")
     log_dir = Path(config["persistence"]["log_directory"])
     log_dir.mkdir(mode=0o775, parents=True, exist_ok=True)
+    return log_dir
+
+
+def module_directory(config, module):
+    log_dir = log_directory(config)
+    if (log_dir / (module + ".log")).is_file():
+        raise RuntimeError("Unmigrated log file %s found, run busybody with '--mode migrate' first." %
+                           (log_dir / (module + ".log")))
+    module_dir = log_dir / module
+    module_dir.mkdir(mode=0o775, parents=True, exist_ok=True)
+    return module_dir
+
+
+def fsync_enabled(config):
+    policy = "always"
+    if "fsync" in config["persistence"] and config["persistence"]["fsync"]:
+        policy = config["persistence"]["fsync"]
+    if policy not in FSYNC_POLICIES:
+        raise RuntimeError("Unknown fsync policy %s, use one of %s." % (policy, ", ".join(FSYNC_POLICIES)))
+    return policy == "always"
+
+
+def encode_lines(events):
+    if orjson:
+        return b"".join(orjson.dumps(event, option=orjson.OPT_APPEND_NEWLINE) for event in events)
+    return "".join('%s\n' % json.dumps(event) for event in events).encode("utf-8")
+
+
+def decode_line(line):
+    if orjson:
+        return orjson.loads(line)
+    return json.loads(line)
+
+
+def write_atomic(path, data, sync):
+    # Readers see either the old or the new file, never a partial one.
+    tmp_path = path.with_name(path.name + ".tmp")
+    with tmp_path.open('wb') as f:
+        f.write(data)
+        if sync:
+            f.flush()
+            os.fsync(f.fileno())
+    tmp_path.replace(path)
+    if sync:
+        sync_directory(path.parent)
+
+
+def sync_directory(directory):
+    fd = os.open(str(directory), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def to_timestamp(value):
+    if isinstance(value, str) and "T" in value:
+        return datetime.timestamp(datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%fZ'))
+    return float(value)
+
+
+def segment_name(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%d") + SEGMENT_SUFFIX
+
+
+def segment_day(name):
+    # Compacted segments are named <day>.log.gz or <day>.<generation>.log.gz.
+    return name.split(".")[0]
+
+
+def segment_files(module_dir):
+    return sorted(list(module_dir.glob("*" + SEGMENT_SUFFIX)) + list(module_dir.glob("*" + COMPRESSED_SUFFIX)))
+
+
+def load_index(module_dir, ts_field):
+    index_file = module_dir / INDEX_FILE
+    if not index_file.is_file():
+        return rebuild_index(module_dir, ts_field)
+    with index_file.open('r') as f:
+        return json.load(f)
+
+
+def save_index(module_dir, index, sync=False):
+    write_atomic(module_dir / INDEX_FILE, json.dumps(index, sort_keys=True).encode("utf-8"), sync)
+
+
+@contextmanager
+def index_lock(module_dir):
+    # Pollers and compaction may run as separate processes, and both load,
+    # change and save the index, so only one of them may do so at a time.
+    with (module_dir / LOCK_FILE).open('a') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def rebuild_index(module_dir, ts_field):
+    # Only needed if the sidecar index went missing, e.g. after a restore.
+    index = {"segments": {}}
+    segments = segment_files(module_dir)
+    if not segments:
+        return index
+    logger.warning("Rebuilding the segment index in %s." % module_dir)
+    for segment in segments:
+        timestamps = [to_timestamp(event[ts_field]) for event in read_segment(segment)]
+        if timestamps:
+            index["segments"][segment.name] = {"first": min(timestamps), "last": max(timestamps),
+                                               "count": len(timestamps),
+                                               "ordered": timestamps == sorted(timestamps)}
+    save_index(module_dir, index)
+    return index
+
+
+def open_segment(segment):
+    if segment.name.endswith(COMPRESSED_SUFFIX):
+        return gzip.open(str(segment), 'rb')
+    return segment.open('rb')
+
+
+def read_segment(segment):
+    with open_segment(segment) as f:
+        yield from read_lines(f, segment)
+
+
+def read_lines(f, segment):
+    for line in f:
+        if len(line) <= 3:
+            continue
+        try:
+            yield decode_line(line)
+        except ValueError:
+            # Left behind by a crash in the middle of a write.
+            logger.warning("Skipping torn line in %s." % segment)
+
+
+def line_start(f, end):
+    # Position just after the last newline before end, or 0 without one.
+    pos = end
+    while pos > 0:
+        step = min(TAIL_CHUNK, pos)
+        pos -= step
+        f.seek(pos)
+        newline = f.read(step).rfind(b"\n")
+        if newline >= 0:
+            return pos + newline + 1
+    return 0
+
+
+def read_last_event(segment):
+    if not segment.is_file():
+        return None
+    if segment.name.endswith(COMPRESSED_SUFFIX):
+        # Only reached if nothing was appended since the last compaction.
+        last_event = None
+        for last_event in read_segment(segment):
+            pass
+        return last_event
+    with segment.open('rb') as f:
+        # Anything after the last newline was torn by a crash.
+        end = line_start(f, f.seek(0, os.SEEK_END))
+        while end > 0:
+            start = line_start(f, end - 1)
+            f.seek(start)
+            line = f.read(end - start)
+            if len(line) > 3:
+                try:
+                    return decode_line(line)
+                except ValueError:
+                    logger.warning("Skipping torn line in %s." % segment)
+            end = start
+    return None
+
+
+def repair_tail(segment):
+    # A line without its newline was cut off by a crash. It is dropped before
+    # appending, so that the next event does not end up glued to it.
+    with segment.open('r+b') as f:
+        size = f.seek(0, os.SEEK_END)
+        end = line_start(f, size)
+        if end < size:
+            logger.warning("Truncating %s torn bytes at the end of %s." % (size - end, segment))
+            f.truncate(end)
+
+
+def get_last(config):
     modules = set()
     if "pollers" in config and config["pollers"]:
         modules.update(config["active_modules"]["pollers"])
@@ -20,18 +229,19 @@ def get_last(config):
     for module in modules:
         config_mod = getattr(sys.modules[module], module)
         ts_field = config_mod.TIMESTAMP_FIELD
-        log_file = log_dir / (module + ".log")
-        log_file.touch(mode=0o660, exist_ok=True)
-        last = ""
-        with log_file.open('r') as f:
-            for line in f:
-                if len(line) > 3:
-                    last = line
+        module_dir = module_directory(config, module)
+        index = load_index(module_dir, ts_field)
+        last_event = None
+        # The index is written ahead of the events, so its newest segment may
+        # not have made it to disk.
+        for name in sorted(index["segments"], key=lambda name: index["segments"][name]["last"], reverse=True):
+            last_event = read_last_event(module_dir / name)
+            if last_event:
+                break
         if "last_polled" not in config:
             config["last_polled"] = {}
         config["last_polled"][module] = {}
-        if last:
-            last_event = json.loads(last)
+        if last_event:
             config["last_polled"][module]["last_polled_time"] = last_event[ts_field]
             config["last_polled"][module]["last_polled_event"] = last_event
         else:
@@ -41,56 +251,255 @@ def get_last(config):
 
 
 def persist(config, data):
-    if "log_directory" not in config["persistence"] or not config["persistence"]["log_directory"]:
-        raise RuntimeError("Flat file persistence requested, but no log_directory specified.")
-    log_dir = Path(config["persistence"]["log_directory"])
-    log_dir.mkdir(mode=0o775, parents=True, exist_ok=True)
     for module in data:
-        log_file = log_dir / (module + ".log")
-        log_file.touch(mode=0o660, exist_ok=True)
-        with log_file.open('a') as f:
-            for entry in data[module]:
-                f.write('%s\n' % json.dumps(entry))
+        if not data[module]:
+            continue
+        ts_field = getattr(sys.modules[module], module).TIMESTAMP_FIELD
+        append_events(module_directory(config, module), ts_field, data[module], fsync_enabled(config))
+
+
+def append_events(module_dir, ts_field, events, sync=False):
+    with index_lock(module_dir):
+        index = load_index(module_dir, ts_field)
+        days = {}
+        for event in events:
+            timestamp = to_timestamp(event[ts_field])
+            day = int(timestamp // 86400)
+            if day not in days:
+                days[day] = []
+            days[day].append((timestamp, event))
+        segments = {segment_name(day * 86400): entries for day, entries in days.items()}
+        for name, entries in segments.items():
+            timestamps = [timestamp for timestamp, entry in entries]
+            ordered = timestamps == sorted(timestamps)
+            if name in index["segments"]:
+                bounds = index["segments"][name]
+                bounds["ordered"] = bounds["ordered"] and ordered and timestamps[0] >= bounds["last"]
+                bounds["first"] = min(bounds["first"], min(timestamps))
+                bounds["last"] = max(bounds["last"], max(timestamps))
+                bounds["count"] += len(timestamps)
+            else:
+                index["segments"][name] = {"first": min(timestamps), "last": max(timestamps),
+                                           "count": len(timestamps), "ordered": ordered}
+        # Written ahead of the events: after a crash the index may cover events
+        # that never made it to disk, which only costs a segment read, but never
+        # misses events that did.
+        save_index(module_dir, index, sync)
+        for name, entries in sorted(segments.items()):
+            segment = module_dir / name
+            segment.touch(mode=0o660, exist_ok=True)
+            repair_tail(segment)
+            # One write per segment, so a crash tears at most its last line.
+            with segment.open('ab') as f:
+                f.write(encode_lines([entry for timestamp, entry in entries]))
+                if sync:
+                    f.flush()
+                    os.fsync(f.fileno())
+
+
+def module_start(config, key, module):
+    # Set by busybody: "history_start" for reads, "window_start" for compaction.
+    if key in config and module in config[key]:
+        return config[key][module]
+    return 0
 
 
 def get_historical_data(config):
     data = {}
-    if "log_directory" not in config["persistence"] or not config["persistence"]["log_directory"]:
-        raise RuntimeError("Flat file persistence requested, but no log_directory specified.")
-    log_dir = Path(config["persistence"]["log_directory"])
-    log_dir.mkdir(mode=0o775, parents=True, exist_ok=True)
     if "analysis" not in config:
         return data
     for module in config["active_modules"]["analysis"]:
-        data[module] = []
-        analysis_mod = getattr(sys.modules[module], module)
-        ts_field = analysis_mod.TIMESTAMP_FIELD
-        if "history_limit" in config:
-            last_time = config["last_polled"][module]["last_polled_time"]
-            if type(last_time) == str and "T" in last_time:
-                last_time = datetime.timestamp(datetime.strptime(last_time, '%Y-%m-%dT%H:%M:%S.%fZ'))
-            limit = max(0, last_time - config["history_limit"])
-        else:
-            limit = 0
-        log_file = log_dir / (module + ".log")
-        log_file.touch(mode=0o660, exist_ok=True)
-        with log_file.open('r') as f:
-            for line in f:
-                event = json.loads(line)
-                timestamp = event[ts_field]
-                if type(timestamp) == str and "T" in timestamp:
-                    timestamp = datetime.timestamp(datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S.%fZ'))
-                if str(timestamp) >= str(limit):
-                    data[module].append(event)
+        data[module] = list(iter_module_history(config, module))
     return data
 
 
+def iter_module_history(config, module):
+    analysis_mod = getattr(sys.modules[module], module)
+    ts_field = analysis_mod.TIMESTAMP_FIELD
+    limit = module_start(config, "history_start", module)
+    module_dir = module_directory(config, module)
+    index = load_index(module_dir, ts_field)
+    days = window_days(index, limit)
+    for day in sorted(days):
+        index, names, files = open_day(module_dir, ts_field, index, day, days[day], limit)
+        try:
+            events = itertools.chain.from_iterable(read_lines(f, module_dir / name) for name, f in zip(names, files))
+            # Events that arrived after a day was compacted are in a segment of
+            # their own, so the day is only in order if it is a single one.
+            ordered = all("ordered" in index["segments"][name] and index["segments"][name]["ordered"]
+                          for name in names)
+            if len(names) > 1 or not ordered:
+                events = sorted(events, key=lambda event: to_timestamp(event[ts_field]))
+            for event in events:
+                if to_timestamp(event[ts_field]) >= limit:
+                    yield event
+        finally:
+            for f in files:
+                f.close()
+
+
+def window_days(index, limit):
+    days = {}
+    for name in index["segments"]:
+        # Segments entirely outside of the history window are never opened.
+        if index["segments"][name]["last"] < limit:
+            continue
+        if segment_day(name) not in days:
+            days[segment_day(name)] = []
+        days[segment_day(name)].append(name)
+    return days
+
+
+def open_day(module_dir, ts_field, index, day, names, limit):
+    # A compaction running at the same time can replace or expire the day's
+    # segments after the index was loaded. All of them are opened before
+    # anything is read, and the index is reloaded if one of them is gone.
+    for attempt in range(OPEN_ATTEMPTS):
+        names = sorted(names)
+        files = []
+        missing = []
+        for name in names:
+            try:
+                files.append(open_segment(module_dir / name))
+            except FileNotFoundError:
+                missing.append(name)
+        if not missing or attempt == OPEN_ATTEMPTS - 1:
+            break
+        for f in files:
+            f.close()
+        index = load_index(module_dir, ts_field)
+        days = window_days(index, limit)
+        names = days[day] if day in days else []
+    if missing:
+        logger.warning("Skipping missing segments %s in %s." % (", ".join(missing), module_dir))
+    return index, [name for name in names if name not in missing], files
+
+
+def compact(config):
+    modules = set(config["active_modules"]["pollers"])
+    if "analysis" in config and config["analysis"]:
+        modules.update(config["active_modules"]["analysis"])
+    archive_dir = None
+    if "archive_directory" in config["persistence"] and config["persistence"]["archive_directory"]:
+        archive_dir = Path(config["persistence"]["archive_directory"])
+    sync = fsync_enabled(config)
+    for module in sorted(modules):
+        compact_module(config, module, archive_dir, sync)
+
+
+def compact_module(config, module, archive_dir, sync):
+    ts_field = getattr(sys.modules[module], module).TIMESTAMP_FIELD
+    module_dir = module_directory(config, module)
+    with index_lock(module_dir):
+        index = load_index(module_dir, ts_field)
+        limit = module_start(config, "window_start", module)
+        days = {}
+        for name in index["segments"]:
+            if segment_day(name) not in days:
+                days[segment_day(name)] = []
+            days[segment_day(name)].append(name)
+        if not days:
+            return
+        # The newest day is still being appended to.
+        newest = max(days)
+        expired = 0
+        compressed = 0
+        for day in sorted(days):
+            names = sorted(days[day])
+            if max(index["segments"][name]["last"] for name in names) < limit:
+                for name in names:
+                    expire_segment(module_dir / name, archive_dir / module if archive_dir else None)
+                    del index["segments"][name]
+                # Readers skip segments that are gone, so the index can follow.
+                save_index(module_dir, index, sync)
+                expired += len(names)
+            elif day != newest and (len(names) > 1 or not names[0].endswith(COMPRESSED_SUFFIX)):
+                compress_day(module_dir, index, day, names, ts_field, sync)
+                compressed += 1
+        logger.info("Compacted %s: %s days compressed, %s segments %s." %
+                    (module, compressed, expired, "archived" if archive_dir else "deleted"))
+
+
+def expire_segment(segment, archive_dir):
+    if not segment.is_file():
+        return
+    if archive_dir:
+        archive_dir.mkdir(mode=0o775, parents=True, exist_ok=True)
+        shutil.move(str(segment), str(archive_dir / segment.name))
+    else:
+        segment.unlink()
+
+
+def compress_day(module_dir, index, day, names, ts_field, sync):
+    events = []
+    for name in names:
+        if (module_dir / name).is_file():
+            events.extend(read_segment(module_dir / name))
+    if not events:
+        for name in names:
+            del index["segments"][name]
+        save_index(module_dir, index, sync)
+        return
+    timestamps = [to_timestamp(event[ts_field]) for event in events]
+    order = sorted(range(len(events)), key=timestamps.__getitem__)
+    # A name the index does not know yet: until the index is saved, readers
+    # keep using the old segments, after that only the new one.
+    target = day + COMPRESSED_SUFFIX
+    generation = 0
+    while target in index["segments"]:
+        generation += 1
+        target = "%s.%d%s" % (day, generation, COMPRESSED_SUFFIX)
+    tmp_path = module_dir / (target + ".tmp")
+    with tmp_path.open('wb') as f:
+        with gzip.GzipFile(filename="", mode='wb', compresslevel=6, fileobj=f, mtime=0) as gz:
+            for start in range(0, len(order), COMPRESS_BATCH):
+                gz.write(encode_lines([events[i] for i in order[start:start + COMPRESS_BATCH]]))
+        if sync:
+            f.flush()
+            os.fsync(f.fileno())
+    tmp_path.replace(module_dir / target)
+    for name in names:
+        del index["segments"][name]
+    index["segments"][target] = {"first": min(timestamps), "last": max(timestamps),
+                                 "count": len(events), "ordered": True}
+    save_index(module_dir, index, sync)
+    for name in names:
+        if (module_dir / name).is_file():
+            (module_dir / name).unlink()
+
+
+def migrate(config):
+    log_dir = log_directory(config)
+    for legacy in sorted(log_dir.glob("*.log")):
+        module = legacy.stem
+        if module not in sys.modules or not hasattr(getattr(sys.modules[module], module), "TIMESTAMP_FIELD"):
+            continue
+        logger.info("Migrating %s into day segments..." % legacy)
+        ts_field = getattr(sys.modules[module], module).TIMESTAMP_FIELD
+        module_dir = log_dir / module
+        module_dir.mkdir(mode=0o775, parents=True, exist_ok=True)
+        batch = []
+        migrated = 0
+        for event in read_segment(legacy):
+            batch.append(event)
+            if len(batch) >= 10000:
+                append_events(module_dir, ts_field, batch)
+                migrated += len(batch)
+                batch = []
+        if batch:
+            append_events(module_dir, ts_field, batch)
+            migrated += len(batch)
+        legacy.rename(legacy.with_suffix(".log.migrated"))
+        logger.info("Migrated %s events from %s." % (migrated, legacy))
+
+
+def last_analyzed_name(config):
+    return config["checkpoint"] + ".log"
+
+
 def get_last_analyzed(config):
-    if "log_directory" not in config["persistence"] or not config["persistence"]["log_directory"]:
-        raise RuntimeError("Flat file persistence requested, but no log_directory specified.")
-    log_dir = Path(config["persistence"]["log_directory"])
-    log_dir.mkdir(mode=0o775, parents=True, exist_ok=True)
-    log_file = log_dir / "last_analyzed.log"
+    log_dir = log_directory(config)
+    log_file = log_dir / last_analyzed_name(config)
     log_file.touch(mode=0o660, exist_ok=True)
     with log_file.open('r') as f:
         try:
@@ -101,11 +510,27 @@ def get_last_analyzed(config):
 
 
 def persist_last_analyzed(config, timestamp):
-    if "log_directory" not in config["persistence"] or not config["persistence"]["log_directory"]:
-        raise RuntimeError("Flat file persistence requested, but no log_directory specified.")
-    log_dir = Path(config["persistence"]["log_directory"])
-    log_dir.mkdir(mode=0o775, parents=True, exist_ok=True)
-    log_file = log_dir / "last_analyzed.log"
-    log_file.touch(mode=0o660, exist_ok=True)
-    with log_file.open('w') as f:
-        json.dump(timestamp, f)
+    log_dir = log_directory(config)
+    write_atomic(log_dir / last_analyzed_name(config), json.dumps(timestamp).encode("utf-8"), fsync_enabled(config))
+
+
+def model_file(config, user):
+    model_dir = log_directory(config) / "models"
+    model_dir.mkdir(mode=0o775, parents=True, exist_ok=True)
+    return model_dir / (hashlib.sha1(user.encode("utf-8")).hexdigest() + ".pkl")
+
+
+def get_model(config, user):
+    model_path = model_file(config, user)
+    if not model_path.is_file():
+        return None
+    with model_path.open('rb') as f:
+        try:
+            return pickle.load(f)
+        except Exception:
+            logger.warning("Discarding unreadable model for %s." % user)
+            return None
+
+
+def persist_model(config, user, model):
+    write_atomic(model_file(config, user), pickle.dumps(model, protocol=pickle.HIGHEST_PROTOCOL), False)
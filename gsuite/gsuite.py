@@ -1,7 +1,4 @@
 import logging
-from collections import Iterable
-from apiclient import discovery
-from oauth2client.service_account import ServiceAccountCredentials
 
 logger = logging.getLogger(__name__)
 
@@ -12,25 +9,41 @@ IP_FIELD = "ipAddress"
 USER_AGENT_FIELD = "events.0.login_type"
 FILTER_FIELD = "events.0.name"
 FILTERED_EVENTS = ["login_failure"]
+UNIQUE_FIELD = "id.uniqueQualifier"
+# Activity parameters carry their value under one of these keys.
+PARAMETER_VALUES = ("value", "intValue", "boolValue", "multiValue", "multiIntValue",
+                    "messageValue", "multiMessageValue")
+MISSING = object()
+# Picked up by busybody's run metrics, totals for the life of the process.
+stats = {
+    "pages": 0,
+    "api_calls": {}
+}
 
 
 def poll(config):
+    from apiclient import discovery
+    from oauth2client.service_account import ServiceAccountCredentials
     data = []
     scopes = ['https://www.googleapis.com/auth/admin.reports.audit.readonly']
     credentials = ServiceAccountCredentials.from_json_keyfile_name(config["pollers"]["gsuite"]["credential_file"], scopes=scopes)
     credentials = credentials.create_delegated(config["pollers"]["gsuite"]["admin_email"])
     service = discovery.build('admin', 'reports_v1', credentials=credentials)
     request = service.activities().list(userKey='all', applicationName='login')
+    full = "flatten" not in config["pollers"]["gsuite"] or config["pollers"]["gsuite"]["flatten"] != "minimal"
+    caught_up = False
     for i in range(1, 101):
         logger.info("Polling page %s..." % i)
         results = request.execute()
+        stats["pages"] += 1
+        stats["api_calls"]["activities.list"] = stats["api_calls"].get("activities.list", 0) + 1
         activities = results.get('items', [])
         for event in activities:
-            flattened = flatten(event)
+            flattened = flatten(event, full)
             if flattened[TIMESTAMP_FIELD] > str(config["last_polled"]["gsuite"]["last_polled_time"]):
                 data.append(flattened)
             elif flattened[TIMESTAMP_FIELD] == str(config["last_polled"]["gsuite"]["last_polled_time"]):
-                if flattened["id.uniqueQualifier"] == config["last_polled"]["gsuite"]["last_polled_event"]["id.uniqueQualifier"]:
+                if flattened[UNIQUE_FIELD] == config["last_polled"]["gsuite"]["last_polled_event"][UNIQUE_FIELD]:
                     caught_up = True
                     break
                 else:
@@ -48,26 +61,76 @@ def notify(config, alerts):
     return
 
 
-def flatten(event, prefix=''):
+def flatten(event, full=True):
+    if not full:
+        return flatten_fields(event)
     flattened = {}
-    for field_no, field in enumerate(event):
-        if 'keys' in dir(event):
+    stack = [(event, "")]
+    while stack:
+        node, prefix = stack.pop()
+        items = node.items() if isinstance(node, dict) else enumerate(node)
+        for field, value in items:
+            key = prefix + str(field)
             # Special case "parameters" values. We should to treat those as dicts.
-            if field == "parameters":
-                for param in event[field]:
-                    if isinstance(param["value"], Iterable) and not isinstance(param["value"], str):
-                        flattened.update(param["value"], prefix + param["name"] + ".")
+            if field == "parameters" and isinstance(node, dict):
+                for param in value:
+                    param_value = parameter_value(param)
+                    if param_value is MISSING:
+                        continue
+                    if isinstance(param_value, (dict, list, tuple)):
+                        stack.append((param_value, prefix + param["name"] + "."))
                     else:
-                        flattened[prefix + param["name"]] = param["value"]
-                continue
+                        flattened[prefix + param["name"]] = param_value
+            elif isinstance(value, (dict, list, tuple)):
+                stack.append((value, key + "."))
             else:
-                nextLevel = event[field]
-                currEntry = prefix + str(field)
-        else:
-            nextLevel = event[field_no]
-            currEntry = prefix + str(field_no)
-        if isinstance(nextLevel, Iterable) and not isinstance(nextLevel, str):
-            flattened.update(flatten(nextLevel, currEntry + "."))
-        else:
-            flattened[currEntry] = nextLevel
+                flattened[key] = value
+    return flattened
+
+
+def flatten_fields(event):
+    # Only the fields busybody reads are flattened, everything else is kept as
+    # it came from the API.
+    flattened = dict(event)
+    for path, steps in FIELD_PATHS:
+        value = extract(event, steps)
+        if value is not MISSING:
+            flattened[path] = value
     return flattened
+
+
+def compile_path(path):
+    return tuple(int(step) if step.isdigit() else step for step in path.split("."))
+
+
+def extract(event, steps):
+    node = event
+    for step in steps:
+        if isinstance(node, dict):
+            if step in node:
+                node = node[step]
+            elif "parameters" in node:
+                for param in node["parameters"]:
+                    if param["name"] == step:
+                        node = parameter_value(param)
+                        break
+                else:
+                    return MISSING
+            else:
+                return MISSING
+        elif isinstance(node, (list, tuple)) and isinstance(step, int) and step < len(node):
+            node = node[step]
+        else:
+            return MISSING
+    return node
+
+
+def parameter_value(param):
+    for kind in PARAMETER_VALUES:
+        if kind in param:
+            return param[kind]
+    return MISSING
+
+
+FIELD_PATHS = [(path, compile_path(path)) for path in
+               (TIMESTAMP_FIELD, USER_FIELD, IP_FIELD, USER_AGENT_FIELD, FILTER_FIELD, UNIQUE_FIELD)]
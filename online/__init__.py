@@ -0,0 +1 @@
+from online import online
@@ -0,0 +1,191 @@
+import sys
+import math
+import logging
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+STATE_VERSION = 2
+EARTH_RADIUS = 6371.0
+DEFAULTS = {
+    "threshold": 2.0,
+    "min_events": 10,
+    "max_speed": 1000.0,
+    "min_distance": 500.0,
+    "spread_factor": 3.0,
+    "max_vocabulary": 100
+}
+# What each signal adds to an event's score.
+WEIGHTS = {
+    "new_asn": 1.0,
+    "new_ua": 1.0,
+    "far": 1.0,
+    "odd_hour": 0.5,
+    "travel": 1.0
+}
+
+
+def settings(config):
+    engine = config["analysis"]["engine"]
+    result = {}
+    for key, default in DEFAULTS.items():
+        if key in engine and engine[key]:
+            result[key] = type(default)(engine[key])
+        else:
+            result[key] = default
+    return result
+
+
+def state_store(config):
+    if "persistence" not in config["active_modules"] or not config["active_modules"]["persistence"]:
+        raise RuntimeError("The online engine needs a persistence module to keep its state in.")
+    persist_module = getattr(sys.modules[config["active_modules"]["persistence"]],
+                             config["active_modules"]["persistence"])
+    if not hasattr(persist_module, "get_model") or not hasattr(persist_module, "persist_model"):
+        raise RuntimeError("The online engine needs a persistence module that can store models.")
+    return persist_module
+
+
+def state_key(user):
+    # Kept apart from the batch engine's cached models of the same user.
+    return "online:" + user
+
+
+def floor_key(config):
+    # Follows the analysis shard's last analyzed checkpoint.
+    return "online." + config["checkpoint"]
+
+
+def history_floor(config):
+    marker = state_store(config).get_model(config, floor_key(config))
+    if not marker or marker["version"] != STATE_VERSION:
+        # Never run before: learn from the whole history once.
+        return 0
+    return marker["last"]
+
+
+def analyzed(config, last):
+    state_store(config).persist_model(config, floor_key(config), {"version": STATE_VERSION, "last": last})
+
+
+def new_state():
+    return {
+        "version": STATE_VERSION,
+        "events": 0,
+        "last_time": None,
+        "last_seen": [],
+        "last_xyz": None,
+        "last_located_time": None,
+        "asns": {},
+        "uas": {},
+        "located": 0,
+        "centroid": [0.0, 0.0, 0.0],
+        "m2": 0.0,
+        "hours": [0] * 24
+    }
+
+
+def distance(a, b):
+    # Great-circle distance between two points on the unit sphere, in km.
+    chord = math.sqrt((a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2 + (a[2] - b[2]) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, chord / 2))
+
+
+def event_key(xyz, asn, ua):
+    return "%s|%s|%s" % (",".join("%.6f" % value for value in xyz), asn, ua)
+
+
+def located(xyz):
+    return not any(math.isnan(value) for value in xyz) and any(xyz)
+
+
+def signals(options, state, ts, xyz, asn, ua):
+    found = []
+    if asn not in state["asns"]:
+        found.append("new_asn")
+    if ua not in state["uas"]:
+        found.append("new_ua")
+    if state["hours"][int(ts // 3600 % 24)] == 0:
+        found.append("odd_hour")
+    if located(xyz) and state["located"]:
+        spread = EARTH_RADIUS * math.sqrt(state["m2"] / state["located"])
+        norm = math.sqrt(sum(value * value for value in state["centroid"]))
+        # The running mean of unit vectors lies inside the sphere, project it
+        # back onto it before measuring.
+        if norm > 0:
+            centroid = [value / norm for value in state["centroid"]]
+            if distance(xyz, centroid) > max(options["min_distance"], options["spread_factor"] * spread):
+                found.append("far")
+    if located(xyz) and state["last_xyz"] is not None:
+        travelled = distance(xyz, state["last_xyz"])
+        hours = max(ts - state["last_located_time"], 1.0) / 3600
+        if travelled > options["min_distance"] and travelled / hours > options["max_speed"]:
+            found.append("travel")
+    return found
+
+
+def count(counts, name, limit):
+    counts[name] = counts.get(name, 0) + 1
+    if len(counts) > limit:
+        # Keeps the state bounded: the rarest other entry makes room.
+        del counts[min((key for key in counts if key != name), key=counts.get)]
+
+
+def update(options, state, ts, xyz, asn, ua):
+    state["events"] += 1
+    count(state["asns"], asn, options["max_vocabulary"])
+    count(state["uas"], ua, options["max_vocabulary"])
+    state["hours"][int(ts // 3600 % 24)] += 1
+    if ts != state["last_time"]:
+        state["last_seen"] = []
+    state["last_seen"].append(event_key(xyz, asn, ua))
+    state["last_time"] = ts
+    if located(xyz):
+        # Welford's update of the mean location and the spread around it.
+        state["located"] += 1
+        delta = [xyz[i] - state["centroid"][i] for i in range(3)]
+        state["centroid"] = [state["centroid"][i] + delta[i] / state["located"] for i in range(3)]
+        state["m2"] += sum(delta[i] * (xyz[i] - state["centroid"][i]) for i in range(3))
+        state["last_xyz"] = list(xyz)
+        state["last_located_time"] = ts
+
+
+def analyze_user(config, user, user_events, asn_names, ua_names, last_analyzed):
+    import numpy
+    options = settings(config)
+    store = state_store(config)
+    state = store.get_model(config, state_key(user))
+    if not state or state["version"] != STATE_VERSION:
+        state = new_state()
+    times = user_events.times
+    start = 0
+    seen = Counter()
+    if state["last_time"] is not None:
+        # Events stored later can share the last second the state learned
+        # from, only the ones it has already seen are skipped.
+        start = int(numpy.searchsorted(times, state["last_time"], side="left"))
+        seen = Counter(state["last_seen"])
+    boundary = state["last_time"]
+    asns = [str(asn) for asn in asn_names[user_events.asns[start:]].tolist()]
+    uas = [str(ua) for ua in ua_names[user_events.uas[start:]].tolist()]
+    events = []
+    for n, (ts, xyz) in enumerate(zip(times[start:].tolist(), user_events.xyz[start:].tolist())):
+        if ts == boundary and seen[event_key(xyz, asns[n], uas[n])]:
+            seen[event_key(xyz, asns[n], uas[n])] -= 1
+            continue
+        events.append((n, ts, xyz))
+    if not events:
+        logger.debug("Skipping user as they have no non-analyzed events.")
+        return None
+    flagged = []
+    for n, ts, xyz in events:
+        # Events from before the last run only teach, e.g. when the state was
+        # just created from the stored history.
+        if ts >= last_analyzed and state["events"] >= options["min_events"]:
+            found = signals(options, state, ts, xyz, asns[n], uas[n])
+            if sum(WEIGHTS[signal] for signal in found) >= options["threshold"]:
+                logger.debug("Event %s of %s flagged for %s." % (start + n, user, ", ".join(found)))
+                flagged.append(start + n)
+        update(options, state, ts, xyz, asns[n], uas[n])
+    store.persist_model(config, state_key(user), state)
+    return numpy.array(flagged, dtype=numpy.int64)
@@ -1,60 +1,249 @@
+import json
+import time
 import logging
-from slackclient import SlackClient
+import threading
+from pathlib import Path
+from datetime import datetime
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger(__name__)
 
+API_URL = "https://slack.com/api"
+API_TIMEOUT = 30
+MAX_RETRIES = 5
+MAX_PAGES = 100
+# Resolve more unknown users than this through users.list instead of users.info.
+BULK_THRESHOLD = 50
+
+# Kept for the life of the process, so a long-running busybody stays warm.
+user_cache = {
+    "entries": {},
+    "loaded": False
+}
+
+# Picked up by busybody's run metrics, totals for the life of the process.
+stats = {
+    "pages": 0,
+    "api_calls": {},
+    "rate_limited": 0,
+    "messages": 0,
+    "undelivered": 0,
+    "user_cache_hits": 0,
+    "user_cache_misses": 0,
+    "user_cache_entries": 0
+}
+stats_lock = threading.Lock()
+# After a 429 every thread holds off until Slack's Retry-After has passed.
+rate_limit = {"until": 0.0}
+
 TIMESTAMP_FIELD = "date_last"
 USER_FIELD = "email"
 IP_FIELD = "ip"
 USER_AGENT_FIELD = "user_agent"
 FILTER_FIELD = None
+# Identify a login as returned by the API, whatever enrich() added to it since.
+LOGIN_FIELDS = ("user_id", "ip", "user_agent", "date_last")
 
 
 def poll(config):
-    slack_api = SlackClient(config["pollers"]["slack"]["api_token"])
+    settings = config["pollers"]["slack"]
+    concurrency = 4
+    if "page_concurrency" in settings and settings["page_concurrency"]:
+        concurrency = int(settings["page_concurrency"])
     data = []
     caught_up = False
-    for i in range(1, 101):
-        logger.info("Polling page %s..." % i)
-        api_data = slack_api.api_call("team.accessLogs", count=1000, page=i)
-        check_api(api_data)
-        for event in api_data["logins"]:
-            if event[TIMESTAMP_FIELD] > config["last_polled"]["slack"]["last_polled_time"]:
-                data.append(event)
-            elif event[TIMESTAMP_FIELD] == config["last_polled"]["slack"]["last_polled_time"]:
-                if str(event) == str(config["last_polled"]["slack"]["last_polled_event"]):
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for first in range(1, MAX_PAGES + 1, concurrency):
+            # Pages are fetched a window at a time, but still processed in order
+            # so that we stop at the first event we have already seen.
+            pages = range(first, min(first + concurrency, MAX_PAGES + 1))
+            for i, api_data in zip(pages, executor.map(lambda page: get_page(settings, page), pages)):
+                for event in api_data["logins"]:
+                    if event[TIMESTAMP_FIELD] > config["last_polled"]["slack"]["last_polled_time"]:
+                        data.append(event)
+                    elif event[TIMESTAMP_FIELD] == config["last_polled"]["slack"]["last_polled_time"]:
+                        if login_key(event) == login_key(config["last_polled"]["slack"]["last_polled_event"]):
+                            caught_up = True
+                            break
+                        else:
+                            data.append(event)
+                    else:
+                        caught_up = True
+                        break
+                if "paging" in api_data and i >= api_data["paging"]["pages"]:
                     caught_up = True
+                if caught_up:
                     break
-                else:
-                    data.append(event)
-            else:
-                caught_up = True
+            if caught_up:
                 break
-        if caught_up:
-            break
     data = enrich(config, data)
     return data
 
 
+def login_key(event):
+    return tuple(event[field] if field in event else None for field in LOGIN_FIELDS)
+
+
+def get_page(settings, page):
+    logger.info("Polling page %s..." % page)
+    api_data = api_call(settings, "team.accessLogs", count=1000, page=page)
+    check_api(api_data)
+    with stats_lock:
+        stats["pages"] += 1
+    return api_data
+
+
+def api_call(settings, method, **params):
+    url = "%s/%s" % (settings["api_url"].rstrip("/") if "api_url" in settings and settings["api_url"]
+                     else API_URL, method)
+    body = urlencode({key: value if isinstance(value, str) else json.dumps(value)
+                      for key, value in params.items()}).encode("utf-8")
+    headers = {"Authorization": "Bearer " + settings["api_token"],
+               "Content-Type": "application/x-www-form-urlencoded"}
+    for attempt in range(MAX_RETRIES + 1):
+        wait = rate_limit["until"] - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        with stats_lock:
+            stats["api_calls"][method] = stats["api_calls"].get(method, 0) + 1
+        try:
+            with urlopen(Request(url, data=body, headers=headers), timeout=API_TIMEOUT) as response:
+                return json.loads(response.read().decode("utf-8"))
+        except HTTPError as e:
+            if e.code != 429 or attempt == MAX_RETRIES:
+                raise
+            delay = float(e.headers["Retry-After"]) if "Retry-After" in e.headers else 2 ** attempt
+            with stats_lock:
+                stats["rate_limited"] += 1
+                rate_limit["until"] = max(rate_limit["until"], time.time() + delay)
+            logger.info("Rate limited on %s, retrying in %s seconds." % (method, delay))
+
+
 def notify(config, alerts):
-    if "channel" not in config["notifiers"]["slack"]:
+    settings = config["notifiers"]["slack"]
+    if "channel" not in settings or not settings["channel"]:
         raise RuntimeError("Slack configured to notify, but no channel specified.")
-    slack_api = SlackClient(config["notifiers"]["slack"]["api_token"])
-    heading = "Busybody has noted a suspicious event!"
-    for alert in alerts:
-        attachment = [{
-            "fallback": heading + "\n" + alert,
-            "title": heading,
-            "text": alert,
-            "color": "#ffe600"
-        }]
-        result = slack_api.api_call("chat.postMessage",
-                                    channel=config["notifiers"]["slack"]["output_channel"],
-                                    attachments=attachment, as_user=True)
-        check_api(result)
+    # Alerts that could not be delivered last time go out with this run's.
+    pending = load_spool(settings) + list(alerts)
+    if not pending:
+        return
+    concurrency = 2
+    if "notify_concurrency" in settings and settings["notify_concurrency"]:
+        concurrency = int(settings["notify_concurrency"])
+    digests = build_digests(settings, pending)
+    logger.info("Sending %s alerts to Slack in %s messages." % (len(pending), len(digests)))
+    undelivered = []
+    delivered = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [(digest, executor.submit(send_digest, settings, digest)) for digest in digests]
+        for digest, future in futures:
+            try:
+                future.result()
+                delivered += 1
+            except Exception as e:
+                logger.warning("Could not deliver %s alerts for %s to Slack: %s" %
+                               (len(digest["alerts"]), digest["user"], e))
+                undelivered.extend(digest["alerts"])
+    with stats_lock:
+        stats["messages"] += delivered
+        stats["undelivered"] += len(undelivered)
+    if not save_spool(settings, undelivered) and undelivered:
+        raise RuntimeError("%s of %s alerts could not be delivered to Slack." % (len(undelivered), len(pending)))
     return
 
 
+def build_digests(settings, alerts):
+    window = 3600
+    if "digest_window" in settings and settings["digest_window"]:
+        window = float(settings["digest_window"])
+    groups = {}
+    for alert in alerts:
+        user = alert["alert_user"] if "alert_user" in alert else "an unknown user"
+        when = alert["alert_time"] if "alert_time" in alert else 0
+        key = (int(when // window) if window > 0 else 0, user)
+        if key not in groups:
+            groups[key] = []
+        groups[key].append(alert)
+    digests = []
+    for (slot, user), grouped in sorted(groups.items()):
+        grouped.sort(key=lambda alert: alert["alert_time"] if "alert_time" in alert else 0)
+        digests.append({"user": user, "alerts": grouped})
+    return digests
+
+
+def send_digest(settings, digest):
+    limit = 20
+    if "digest_size" in settings and settings["digest_size"]:
+        limit = int(settings["digest_size"])
+    alerts = digest["alerts"]
+    heading = "Busybody has noted %s suspicious event%s for %s!" % \
+        (len(alerts), "" if len(alerts) == 1 else "s", digest["user"])
+    lines = [alert_line(alert) for alert in alerts[:limit]]
+    if len(alerts) > limit:
+        lines.append("...and %s more." % (len(alerts) - limit))
+    attachment = [{
+        "fallback": heading + "\n" + "\n".join(lines),
+        "title": heading,
+        "text": "\n".join(lines),
+        "color": "#ffe600"
+    }]
+    result = api_call(settings, "chat.postMessage", channel=settings["channel"],
+                      attachments=attachment, as_user=True)
+    check_api(result)
+
+
+def alert_line(alert):
+    details = []
+    if "alert_time" in alert:
+        details.append(datetime.fromtimestamp(alert["alert_time"]).strftime("%Y-%m-%d %H:%M:%S"))
+    if "ip_location" in alert and alert["ip_location"]:
+        details.append(alert["ip_location"])
+    if "asn" in alert and alert["asn"]:
+        details.append(alert["asn"])
+    event = {key: value for key, value in alert.items() if key not in ("alert_user", "alert_time")}
+    return "%s: `%s`" % (", ".join(details) or "Event", json.dumps(event, sort_keys=True, default=str))
+
+
+def load_spool(settings):
+    if "spool_file" not in settings or not settings["spool_file"]:
+        return []
+    spool_file = Path(settings["spool_file"])
+    if not spool_file.is_file():
+        return []
+    alerts = []
+    with spool_file.open('r') as f:
+        for line in f:
+            try:
+                alerts.append(json.loads(line))
+            except ValueError:
+                logger.warning("Skipping unreadable line in Slack spool file %s." % spool_file)
+    if alerts:
+        logger.info("Retrying %s undelivered alerts from %s." % (len(alerts), spool_file))
+    return alerts
+
+
+def save_spool(settings, alerts):
+    # The spool is only replaced once delivery is over, so a crash in
+    # between can at worst send an alert twice.
+    if "spool_file" not in settings or not settings["spool_file"]:
+        return False
+    spool_file = Path(settings["spool_file"])
+    if not alerts:
+        if spool_file.is_file():
+            spool_file.unlink()
+        return True
+    tmp_file = spool_file.with_suffix(".tmp")
+    with tmp_file.open('w') as f:
+        for alert in alerts:
+            f.write('%s\n' % json.dumps(alert, default=str))
+    tmp_file.replace(spool_file)
+    logger.warning("Spooled %s undelivered alerts to %s." % (len(alerts), spool_file))
+    return True
+
+
 def check_api(data):
     if not data["ok"]:
         raise RuntimeError("Slack API returned an error: " + str(data))
@@ -63,21 +252,15 @@ def check_api(data):
 
 
 def enrich(config, data):
+    settings = config["pollers"]["slack"]
     unique_users = list(set([e["user_id"] for e in data]))
-    slack_api = SlackClient(config["pollers"]["slack"]["api_token"])
+    profiles = resolve_users(settings, unique_users)
     user_map = {}
-
     for user in unique_users:
-        user_info = slack_api.api_call("users.info", user=user)
-        check_api(user_info)
-        logger.debug(user_info)
-        if "is_bot" in user_info["user"] and user_info["user"]["is_bot"]:
+        if user not in profiles or profiles[user]["bot"] or not profiles[user]["email"]:
             continue
-        elif "is_app_user" in user_info["user"] and user_info["user"]["is_app_user"]:
-            continue
-        elif "profile" in user_info["user"] and "email" in user_info["user"]["profile"]:
-            user_map[user] = user_info["user"]["profile"]["email"]
-            logger.debug("Mapping user %s to %s." % (user, user_map[user]))
+        user_map[user] = profiles[user]["email"]
+        logger.debug("Mapping user %s to %s." % (user, user_map[user]))
     new_data = []
     for entry in data:
         if entry["user_id"] in user_map:
@@ -85,3 +268,100 @@ def enrich(config, data):
             new_data.append(entry)
     logger.debug("Returning %s records." % len(new_data))
     return new_data
+
+
+def resolve_users(settings, users):
+    load_user_cache(settings)
+    ttl = 86400
+    if "user_cache_ttl" in settings and settings["user_cache_ttl"]:
+        ttl = float(settings["user_cache_ttl"])
+    now = time.time()
+    entries = user_cache["entries"]
+    profiles = {}
+    misses = []
+    for user in users:
+        if user in entries and now - entries[user]["fetched"] < ttl:
+            profiles[user] = entries[user]
+        else:
+            misses.append(user)
+    with stats_lock:
+        stats["user_cache_hits"] += len(profiles)
+        stats["user_cache_misses"] += len(misses)
+    if len(misses) > BULK_THRESHOLD:
+        # A cold or expired cache is cheaper to refill from the paginated
+        # user list than with one users.info call per user.
+        bulk_load_users(settings)
+        profiles.update({user: entries[user] for user in misses if user in entries})
+        misses = [user for user in misses if user not in entries]
+    if misses:
+        concurrency = 8
+        if "user_concurrency" in settings and settings["user_concurrency"]:
+            concurrency = int(settings["user_concurrency"])
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for user, user_info in zip(misses, executor.map(lambda user: get_user(settings, user), misses)):
+                entries[user] = user_entry(user_info["user"], now)
+                profiles[user] = entries[user]
+    save_user_cache(settings)
+    with stats_lock:
+        stats["user_cache_entries"] = len(entries)
+        hits, total = stats["user_cache_hits"], stats["user_cache_hits"] + stats["user_cache_misses"]
+    logger.info("Slack user cache: %s entries, %s hits, %s misses (%.1f%% hit rate)." %
+                (len(entries), hits, total - hits, 100.0 * hits / total if total else 0))
+    return profiles
+
+
+def get_user(settings, user):
+    user_info = api_call(settings, "users.info", user=user)
+    check_api(user_info)
+    logger.debug(user_info)
+    return user_info
+
+
+def user_entry(user, fetched):
+    bot = ("is_bot" in user and user["is_bot"]) or ("is_app_user" in user and user["is_app_user"])
+    email = None
+    if "profile" in user and "email" in user["profile"]:
+        email = user["profile"]["email"]
+    return {"email": email, "bot": bool(bot), "fetched": fetched}
+
+
+def bulk_load_users(settings):
+    cursor = ""
+    now = time.time()
+    loaded = 0
+    while True:
+        result = api_call(settings, "users.list", limit=200, cursor=cursor)
+        check_api(result)
+        for member in result["members"]:
+            user_cache["entries"][member["id"]] = user_entry(member, now)
+            loaded += 1
+        if "response_metadata" not in result or not result["response_metadata"]["next_cursor"]:
+            break
+        cursor = result["response_metadata"]["next_cursor"]
+    logger.info("Loaded %s users from users.list." % loaded)
+
+
+def load_user_cache(settings):
+    if user_cache["loaded"]:
+        return
+    user_cache["loaded"] = True
+    if "user_cache_file" not in settings or not settings["user_cache_file"]:
+        return
+    cache_file = Path(settings["user_cache_file"])
+    if not cache_file.is_file():
+        return
+    with cache_file.open('r') as f:
+        try:
+            user_cache["entries"].update(json.load(f))
+        except ValueError:
+            logger.warning("Ignoring unreadable Slack user cache %s." % cache_file)
+
+
+def save_user_cache(settings):
+    if "user_cache_file" not in settings or not settings["user_cache_file"]:
+        return
+    cache_file = Path(settings["user_cache_file"])
+    tmp_file = cache_file.with_suffix(".tmp")
+    with tmp_file.open('w') as f:
+        json.dump(user_cache["entries"], f)
+    tmp_file.replace(cache_file)
@@ -0,0 +1,246 @@
+import os
+import sys
+import json
+import pickle
+import sqlite3
+import logging
+import threading
+from pathlib import Path
+from flatfile import flatfile
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_VERSION = 1
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    module TEXT NOT NULL,
+    ts REAL NOT NULL,
+    user TEXT,
+    raw TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_module_ts ON events (module, ts);
+CREATE INDEX IF NOT EXISTS events_user_ts ON events (user, ts);
+CREATE TABLE IF NOT EXISTS checkpoints (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS models (
+    user TEXT PRIMARY KEY,
+    model BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS imports (
+    path TEXT PRIMARY KEY,
+    events INTEGER NOT NULL
+);
+"""
+BATCH_SIZE = 10000
+
+# sqlite3 connections may not cross threads or forked analysis workers, so
+# every process and thread opens its own.
+connections = {}
+
+
+def connect(config):
+    if "database" not in config["persistence"] or not config["persistence"]["database"]:
+        raise RuntimeError("SQLite persistence requested, but no database specified.")
+    database = Path(config["persistence"]["database"])
+    key = (os.getpid(), threading.get_ident(), str(database))
+    if key not in connections:
+        database.parent.mkdir(mode=0o775, parents=True, exist_ok=True)
+        db = sqlite3.connect(str(database), timeout=60)
+        # Only takes effect on a new database, see compact().
+        db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        db.execute("PRAGMA journal_mode=WAL")
+        # In WAL mode this is still safe against corruption, a power loss can
+        # only cost the last transactions.
+        db.execute("PRAGMA synchronous=NORMAL")
+        version = db.execute("PRAGMA user_version").fetchone()[0]
+        if version > SCHEMA_VERSION:
+            raise RuntimeError("Database %s was written by a newer busybody (schema %s)." % (database, version))
+        db.executescript(SCHEMA)
+        db.execute("PRAGMA user_version=%d" % SCHEMA_VERSION)
+        connections[key] = db
+    return connections[key]
+
+
+def get_last(config):
+    modules = set()
+    if "pollers" in config and config["pollers"]:
+        modules.update(config["active_modules"]["pollers"])
+    if "analysis" in config and config["analysis"]:
+        modules.update(config["active_modules"]["analysis"])
+    db = connect(config)
+    for module in modules:
+        config_mod = getattr(sys.modules[module], module)
+        ts_field = config_mod.TIMESTAMP_FIELD
+        # Ties go to the event stored last, as with flatfile's last line.
+        row = db.execute("SELECT raw FROM events WHERE module = ? ORDER BY ts DESC, id DESC LIMIT 1",
+                         (module,)).fetchone()
+        if "last_polled" not in config:
+            config["last_polled"] = {}
+        config["last_polled"][module] = {}
+        if row:
+            last_event = json.loads(row[0])
+            config["last_polled"][module]["last_polled_time"] = last_event[ts_field]
+            config["last_polled"][module]["last_polled_event"] = last_event
+        else:
+            config["last_polled"][module]["last_polled_time"] = 0
+            config["last_polled"][module]["last_polled_event"] = {}
+    return config
+
+
+def persist(config, data):
+    db = connect(config)
+    with db:
+        for module in data:
+            if not data[module]:
+                continue
+            insert_events(db, module, data[module])
+
+
+def insert_events(db, module, events):
+    config_mod = getattr(sys.modules[module], module)
+    ts_field = config_mod.TIMESTAMP_FIELD
+    user_field = config_mod.USER_FIELD
+    db.executemany("INSERT INTO events (module, ts, user, raw) VALUES (?, ?, ?, ?)",
+                   ((module, flatfile.to_timestamp(event[ts_field]), event[user_field] if user_field in event else None,
+                     json.dumps(event)) for event in events))
+
+
+def get_historical_data(config):
+    data = {}
+    if "analysis" not in config:
+        return data
+    for module in config["active_modules"]["analysis"]:
+        data[module] = list(iter_module_history(config, module))
+    return data
+
+
+def iter_module_history(config, module):
+    limit = 0
+    if "history_start" in config and module in config["history_start"]:
+        limit = config["history_start"][module]
+    # A range scan over the (module, ts) index, already in timestamp order.
+    cursor = connect(config).execute("SELECT raw FROM events WHERE module = ? AND ts >= ? ORDER BY ts, id",
+                                     (module, limit))
+    for row in cursor:
+        yield json.loads(row[0])
+
+
+def iter_user_history(config, user, start=0, module=None):
+    # Takes the user as stored by the module, i.e. before any user_map or
+    # user_domain is applied.
+    query = "SELECT raw FROM events WHERE user = ? AND ts >= ?"
+    params = [user, start]
+    if module:
+        query += " AND module = ?"
+        params.append(module)
+    for row in connect(config).execute(query + " ORDER BY ts, id", params):
+        yield json.loads(row[0])
+
+
+def get_last_analyzed(config):
+    row = connect(config).execute("SELECT value FROM checkpoints WHERE name = ?",
+                                  (config["checkpoint"],)).fetchone()
+    if not row:
+        return 0
+    return json.loads(row[0])
+
+
+def persist_last_analyzed(config, timestamp):
+    db = connect(config)
+    with db:
+        db.execute("INSERT OR REPLACE INTO checkpoints (name, value) VALUES (?, ?)",
+                   (config["checkpoint"], json.dumps(timestamp)))
+
+
+def get_model(config, user):
+    row = connect(config).execute("SELECT model FROM models WHERE user = ?", (user,)).fetchone()
+    if not row:
+        return None
+    try:
+        return pickle.loads(row[0])
+    except Exception:
+        logger.warning("Discarding unreadable model for %s." % user)
+        return None
+
+
+def persist_model(config, user, model):
+    db = connect(config)
+    with db:
+        db.execute("INSERT OR REPLACE INTO models (user, model) VALUES (?, ?)",
+                   (user, pickle.dumps(model, protocol=pickle.HIGHEST_PROTOCOL)))
+
+
+def compact(config):
+    if "archive_directory" in config["persistence"] and config["persistence"]["archive_directory"]:
+        raise RuntimeError("SQLite persistence cannot archive events, remove archive_directory to delete them.")
+    db = connect(config)
+    deleted = 0
+    for module in sorted(config["window_start"]):
+        limit = config["window_start"][module]
+        if not limit:
+            continue
+        with db:
+            deleted += db.execute("DELETE FROM events WHERE module = ? AND ts < ?", (module, limit)).rowcount
+    if "vacuum" in config["persistence"] and config["persistence"]["vacuum"]:
+        # Rewrites the whole database under an exclusive lock, which also
+        # turns on incremental vacuuming for databases created without it.
+        db.execute("VACUUM")
+    elif deleted and db.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        # Hands the freed pages back to the file system without rewriting
+        # the rest, so pollers are not locked out for long. executescript()
+        # steps the pragma until it is done, execute() would free one page.
+        db.executescript("PRAGMA incremental_vacuum")
+    logger.info("Compacted %s: %s events deleted." % (config["persistence"]["database"], deleted))
+
+
+def migrate(config):
+    # Imports the logs of a flatfile log directory. Files that have been
+    # imported before are skipped, so this can be rerun after an interruption.
+    if "flatfile_directory" not in config["persistence"] or not config["persistence"]["flatfile_directory"]:
+        raise RuntimeError("SQLite migration requested, but no flatfile_directory specified.")
+    log_dir = Path(config["persistence"]["flatfile_directory"])
+    db = connect(config)
+    for module in sorted(set(config["active_modules"]["pollers"] + config["active_modules"]["analysis"])):
+        module_dir = log_dir / module
+        sources = flatfile.segment_files(module_dir) if module_dir.is_dir() else []
+        # Logs that flatfile has already split up are left alone, their
+        # events are in the day files.
+        if (log_dir / (module + ".log")).is_file():
+            sources.insert(0, log_dir / (module + ".log"))
+        for source in sources:
+            import_file(db, module, source, flatfile.read_segment)
+    for checkpoint in sorted(log_dir.glob("last_analyzed*.log")):
+        name = checkpoint.name[:-len(".log")]
+        with checkpoint.open('r') as f:
+            try:
+                timestamp = json.load(f)
+            except ValueError:
+                continue
+        with db:
+            db.execute("INSERT OR IGNORE INTO checkpoints (name, value) VALUES (?, ?)",
+                       (name, json.dumps(timestamp)))
+
+
+def import_file(db, module, source, read_events):
+    if db.execute("SELECT 1 FROM imports WHERE path = ?", (str(source.resolve()),)).fetchone():
+        logger.debug("Skipping %s, it has already been imported." % source)
+        return
+    logger.info("Importing %s..." % source)
+    imported = 0
+    batch = []
+    # One transaction per file, so a file is either imported completely or not at all.
+    with db:
+        for event in read_events(source):
+            batch.append(event)
+            if len(batch) >= BATCH_SIZE:
+                insert_events(db, module, batch)
+                imported += len(batch)
+                batch = []
+        if batch:
+            insert_events(db, module, batch)
+            imported += len(batch)
+        db.execute("INSERT INTO imports (path, events) VALUES (?, ?)", (str(source.resolve()), imported))
+    logger.info("Imported %s events from %s." % (imported, source))